@@ -0,0 +1,317 @@
+import os, sys
+import subprocess
+import tempfile
+from fractions import Fraction
+import numpy as np
+from scipy import signal
+from scipy import fft
+import ffmpegio
+
+import logging
+logger = logging.getLogger('label3d')
+
+# samples of audio to read from ffmpeg at a time
+AUDIO_BLOCK_SIZE = 1 << 20
+
+def decimation_factors(dec: int) -> list:
+    """Splits a decimation factor into stages that are each small enough to filter well."""
+    if dec > 13:
+        return [8, int(dec/8)]
+    else:
+        return [int(dec)]
+
+class FIRDecimator:
+    """Lowpass filters and downsamples a signal that arrives in blocks.
+
+    Uses the same linear phase FIR filter as `scipy.signal.decimate(x, q, ftype='fir')`,
+    centered so that it has no delay. Samples that straddle two blocks are carried
+    over to the next one, so the output is the same as filtering the whole signal
+    at once, but memory only depends on the block size.
+
+    Args:
+        q: Downsampling factor
+    """
+    def __init__(self, q: int):
+        self.q = q
+        self.h = signal.firwin(20*q + 1, 1. / q, window='hamming')
+
+        # pad the start with half a filter of zeros, so that the output is centered
+        self._carry = np.zeros(len(self.h) // 2)
+
+    def process(self, x: np.ndarray) -> np.ndarray:
+        z = np.concatenate((self._carry, x))
+
+        ntaps = len(self.h)
+        if len(z) < ntaps:
+            self._carry = z
+            return np.empty((0,))
+
+        nout = (len(z) - ntaps) // self.q + 1
+        # filter output for each full window, then keep every qth one
+        y = signal.fftconvolve(z, self.h[::-1], mode='valid')[:nout*self.q:self.q]
+
+        # keep everything from the start of the next window, which is always a
+        # multiple of q from the start of this one
+        self._carry = z[nout*self.q:]
+        return y
+
+    def flush(self) -> np.ndarray:
+        """Returns the last outputs, padding the end with zeros like the start."""
+        y = self.process(np.zeros(len(self.h) // 2))
+        self._carry = np.zeros(len(self.h) // 2)
+        return y
+
+def read_audio_blocks(filename: str, blocksize: int = AUDIO_BLOCK_SIZE):
+    """Yields the first channel of the first audio stream as float32 blocks.
+
+    Streams the audio through an ffmpeg pipe, so that the whole track is never in
+    memory at once.
+    """
+    cmd = [ffmpegio.path.get_ffmpeg(), '-v', 'error', '-nostdin',
+           '-i', filename, '-map', '0:a:0', '-vn', '-sn',
+           '-af', 'pan=mono|c0=c0', '-f', 'f32le', '-acodec', 'pcm_f32le', '-']
+    logger.debug("Command: {}".format(' '.join(cmd)))
+
+    # stderr goes to a file, so that it can't fill up a pipe and stall ffmpeg
+    errfile = tempfile.TemporaryFile()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errfile)
+    try:
+        nbytes = blocksize * 4
+        while True:
+            data = proc.stdout.read(nbytes)
+            if not data:
+                break
+            # drop a partial sample at the very end, if there is one
+            data = data[:len(data) - len(data) % 4]
+            yield np.frombuffer(data, dtype='<f4')
+
+        proc.wait()
+        if proc.returncode != 0:
+            errfile.seek(0)
+            msg = errfile.read().decode(errors='replace').strip()
+            raise OSError(f"ffmpeg could not decode the audio in {filename}: {msg}")
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        proc.stdout.close()
+        errfile.close()
+
+def audio_envelope(filename: str, hirate: float, target_rate: float = 1000,
+                   blocksize: int = AUDIO_BLOCK_SIZE):
+    """Computes the amplitude envelope of a file's audio in one streaming pass.
+
+    Takes the absolute value of the first audio channel and decimates it to about
+    `target_rate`, one block at a time, carrying the filter state across blocks.
+
+    Args:
+        filename: Media file to read
+        hirate: Sample rate of the audio stream
+        target_rate: Approximate sample rate of the envelope
+        blocksize: Number of samples to read at a time
+
+    Returns:
+        (rate, envelope)
+    """
+    dec = decimation_factors(round(hirate/target_rate))
+    logger.debug(f"Decimate audio by {dec}")
+
+    stages = [FIRDecimator(d1) for d1 in dec]
+
+    def run_stages(x, i0=0):
+        for stage in stages[i0:]:
+            x = stage.process(x)
+        return x
+
+    out = []
+    nsamples = 0
+    for block in read_audio_blocks(filename, blocksize):
+        nsamples += len(block)
+        out.append(run_stages(np.abs(block.astype(np.float64))))
+
+    if nsamples == 0:
+        raise ValueError(f"No audio samples in {filename}")
+
+    # flush each stage in turn, passing what comes out through the later ones
+    for i, stage in enumerate(stages):
+        out.append(run_stages(stage.flush(), i+1))
+
+    rate = hirate / np.prod(dec)
+    return rate, np.concatenate(out)
+
+class MinMaxPyramid:
+    """Minimum and maximum of a signal over bins of 2, 4, 8, ... samples.
+
+    Drawing the min/max pair for each bin at a level with a couple of bins per
+    pixel looks the same as drawing every sample, but the number of points only
+    depends on the width of the plot.
+
+    Args:
+        y: Signal to summarize
+        rate: Sample rate of the signal
+        t0: Time of the first sample
+    """
+    # stop making coarser levels once they are this short
+    MIN_LEVEL_SIZE = 512
+
+    def __init__(self, y: np.ndarray, rate: float, t0: float = 0):
+        self.rate = rate
+        self.t0 = t0
+
+        y = np.asarray(y)
+        self.levels = [(y, y)]
+
+        mn, mx = y, y
+        while len(mn) > self.MIN_LEVEL_SIZE:
+            if len(mn) % 2 == 1:
+                mn = np.append(mn, mn[-1])
+                mx = np.append(mx, mx[-1])
+
+            mn = np.minimum(mn[0::2], mn[1::2])
+            mx = np.maximum(mx[0::2], mx[1::2])
+            self.levels.append((mn, mx))
+
+    def __len__(self) -> int:
+        return len(self.levels[0][0])
+
+    @property
+    def duration(self) -> float:
+        return len(self) / self.rate
+
+    def choose_level(self, tmin: float, tmax: float, npixels: int) -> int:
+        """Returns the coarsest level that still has at least two bins per pixel."""
+        samples_per_pixel = (tmax - tmin) * self.rate / max(npixels, 1)
+        if samples_per_pixel < 4:
+            return 0
+
+        level = int(np.floor(np.log2(samples_per_pixel / 2)))
+        return min(level, len(self.levels) - 1)
+
+    def get(self, tmin: float, tmax: float, npixels: int):
+        """Returns (t, y) to plot the signal between tmin and tmax, npixels wide.
+
+        At coarse levels, y alternates between the minimum and maximum of each bin,
+        so it should be drawn with all of the points connected.
+        """
+        level = self.choose_level(tmin, tmax, npixels)
+        binsize = 2 ** level
+        mn, mx = self.levels[level]
+
+        # include one bin on either side, so the line runs off the edge of the plot
+        i0 = int(np.floor((tmin - self.t0) * self.rate / binsize)) - 1
+        i1 = int(np.ceil((tmax - self.t0) * self.rate / binsize)) + 1
+        i0 = min(max(i0, 0), len(mn))
+        i1 = min(max(i1, i0), len(mn))
+
+        if level == 0:
+            t = self.t0 + np.arange(i0, i1) / self.rate
+            return t, mn[i0:i1]
+
+        t = self.t0 + (np.arange(i0, i1) + 0.5) * binsize / self.rate
+        t = np.repeat(t, 2)
+        y = np.column_stack((mn[i0:i1], mx[i0:i1])).ravel()
+        return t, y
+
+def _parabolic_peak(c: np.ndarray, i: int) -> float:
+    """Refines the position of a peak at c[i] by fitting a parabola through its neighbors."""
+    if i <= 0 or i >= len(c) - 1:
+        return float(i)
+
+    y0, y1, y2 = c[i-1], c[i], c[i+1]
+    denom = y0 - 2*y1 + y2
+    if denom == 0:
+        return float(i)
+    return i + 0.5 * (y0 - y2) / denom
+
+def cross_correlation_lag(a: np.ndarray, b: np.ndarray, rate: float,
+                          center: float = 0.0, window: float = None):
+    """Finds how much later events happen in `a` than in `b`, by FFT cross-correlation.
+
+    The whole cross-correlation comes from one pair of FFTs, so this is
+    O(n log n) in the length of the signals. The peak is refined to a fraction of
+    a sample by parabolic interpolation.
+
+    Args:
+        a, b: Signals at the same sample rate, like audio envelopes
+        rate: Sample rate
+        center: Expected lag, in seconds
+        window: Only look for lags within this many seconds of `center`. If None,
+            search all lags.
+
+    Returns:
+        (lag, confidence): lag in seconds, and the normalized correlation at the
+            peak, which is 1 for a perfect match and near 0 for no match
+    """
+    a = np.asarray(a, dtype=np.float64) - np.mean(a)
+    b = np.asarray(b, dtype=np.float64) - np.mean(b)
+
+    n = fft.next_fast_len(len(a) + len(b) - 1, real=True)
+    c = fft.irfft(fft.rfft(a, n) * np.conj(fft.rfft(b, n)), n)
+
+    # c[k] is the correlation at lag k. Negative lags wrap around to the end
+    lo, hi = -(len(b) - 1), len(a) - 1
+    if window is not None:
+        lo = max(lo, int(np.floor((center - window) * rate)))
+        hi = min(hi, int(np.ceil((center + window) * rate)))
+    if lo > hi:
+        raise ValueError(f"No overlap between the signals within {window}s of a {center}s lag")
+
+    lags = np.arange(lo, hi + 1)
+    cwin = c[lags % n]
+
+    ipk = int(np.argmax(cwin))
+    lag = (lo + _parabolic_peak(cwin, ipk)) / rate
+
+    norm = np.sqrt(np.sum(a**2) * np.sum(b**2))
+    confidence = float(cwin[ipk] / norm) if norm > 0 else 0.0
+
+    return lag, confidence
+
+def resample_envelopes(envelopes: list, rates: list):
+    """Resamples envelopes to the lowest of their sample rates.
+
+    For example, a 44.1 kHz track gives a 1102.5 Hz envelope and a 48 kHz track
+    gives 1000 Hz, and both need to be at 1000 Hz to cross-correlate them.
+
+    Returns:
+        (rate, envelopes)
+    """
+    rate = min(rates)
+
+    out = []
+    for env, rate1 in zip(envelopes, rates):
+        if rate1 == rate:
+            out.append(np.asarray(env))
+        else:
+            ratio = Fraction(rate / rate1).limit_denominator(1000)
+            out.append(signal.resample_poly(env, ratio.numerator, ratio.denominator))
+
+    return rate, out
+
+def audio_offsets(envelopes: list, rate: float, centers: list = None, window: float = None):
+    """Estimates the offset of each audio envelope relative to the first one.
+
+    Args:
+        envelopes: Audio envelopes, all at the same rate
+        rate: Sample rate of the envelopes
+        centers: Expected offset of each envelope in seconds, for example from the
+            timecodes. Defaults to 0.
+        window: How far from `centers` to search, in seconds. If None, search all
+            offsets.
+
+    Returns:
+        (offsets, confidences): offsets[i] is how many seconds later an event
+            happens in envelope i than in envelope 0, and confidences[i] is the
+            normalized correlation for the pair (0, i)
+    """
+    if centers is None:
+        centers = [0.0] * len(envelopes)
+
+    offsets = [0.0]
+    confidences = [1.0]
+    for env, center in zip(envelopes[1:], centers[1:]):
+        lag, conf = cross_correlation_lag(env, envelopes[0], rate, center=center, window=window)
+        offsets.append(lag)
+        confidences.append(conf)
+
+    return offsets, confidences
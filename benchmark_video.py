@@ -0,0 +1,103 @@
+import os, sys
+import argparse
+import logging
+import tempfile
+from time import perf_counter
+import numpy as np
+import cv2
+
+from videofile import Video
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+                        prog='benchmark_video',
+                        description='Measure frame read speed for different access patterns')
+
+    parser.add_argument('file', nargs='?', help="Video file to read. If not given, a test clip is generated")
+    parser.add_argument('--nframes', help="Number of frames in the generated test clip",
+                        type=int, default=600)
+    parser.add_argument('--size', help="Frame size (width height) of the generated test clip",
+                        type=int, nargs=2, default=[1280, 720])
+    parser.add_argument('--stride', help="Frame step for strided access",
+                        type=int, default=10)
+    parser.add_argument('--nrandom', help="Number of frames to read for random access",
+                        type=int, default=100)
+    parser.add_argument('--seed', help="Random seed for random access",
+                        type=int, default=0)
+    parser.add_argument('--backends', help="Video backends to compare",
+                        nargs='+', choices=['opencv', 'ffmpeg'], default=['opencv', 'ffmpeg'])
+    parser.add_argument('--threads', help="Number of decoding threads for the ffmpeg backend (0 = auto)",
+                        type=int, default=0)
+    return parser
+
+def make_test_clip(filename, nframes, size, fps=30):
+    """Writes a clip with a moving pattern, so that frames don't compress to nothing."""
+    width, height = size
+    out = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+
+    x = np.arange(width)[np.newaxis, :]
+    y = np.arange(height)[:, np.newaxis]
+    for i in range(nframes):
+        img = np.zeros((height, width, 3), dtype=np.uint8)
+        img[:, :, 0] = ((x + 4*i) % 256)
+        img[:, :, 1] = ((y + 2*i) % 256)
+        img[:, :, 2] = ((x + y + i) % 256)
+        cv2.putText(img, str(i), (50, height // 2), cv2.FONT_HERSHEY_SIMPLEX,
+                    4, (255, 255, 255), 8)
+        out.write(img)
+
+    out.release()
+
+def access_patterns(nframes, stride, nrandom, seed):
+    rng = np.random.default_rng(seed)
+    return {'sequential': np.arange(nframes),
+            'strided': np.arange(0, nframes, stride),
+            'random': rng.integers(0, nframes, size=min(nrandom, nframes))}
+
+def time_reads(filename, framenums, **kwargs):
+    # turn off the cache and read-ahead, so that every frame is actually decoded
+    vid = Video.from_media(filename, cache_size=0, **kwargs)
+    # build the keyframe index up front, so that the ffprobe scan isn't timed
+    vid.build_keyframe_index()
+
+    t0 = perf_counter()
+    for fr in framenums:
+        vid.get_frame(int(fr))
+    dt = perf_counter() - t0
+
+    stats = vid.seek_stats
+    vid.close()
+
+    return len(framenums) / dt, stats
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+
+    parser = build_parser()
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if args.file is None:
+            filename = os.path.join(tmpdir, 'test_clip.mp4')
+            print("Generating {} frame test clip at {}x{}".format(args.nframes, *args.size))
+            make_test_clip(filename, args.nframes, args.size)
+        else:
+            filename = args.file
+
+        nframes = len(Video.from_media(filename))
+        patterns = access_patterns(nframes, args.stride, args.nrandom, args.seed)
+
+        print("{:<8s} {:<12s} {:>8s} {:>10s} {:>8s} {:>8s}".format('backend', 'pattern', 'frames',
+                                                                 'frames/s', 'seeks', 'decoded'))
+        for backend in args.backends:
+            kwargs = {'backend': backend}
+            if backend == 'ffmpeg':
+                kwargs['threads'] = args.threads
+
+            for name, framenums in patterns.items():
+                fps, stats = time_reads(filename, framenums, **kwargs)
+                print("{:<8s} {:<12s} {:>8d} {:>10.1f} {:>8d} {:>8d}".format(backend, name, len(framenums),
+                                                                         fps, stats.seeks, stats.decoded))
+
+if __name__ == '__main__':
+    main()
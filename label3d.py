@@ -27,7 +27,7 @@ from widgets.videowindow import VideoWindow
 from videofile import Video
 from triangulate import Calibration
 from points import Points
-from project import Project
+from project import Project, SyncEstimator
 
 from settings import SETTINGS_FILE, DEBUG_CALIBRATION
 
@@ -42,6 +42,7 @@ parameterDefinitions = [
 
 class MainWindow(QMainWindow):
     _cameraParams = None
+    _syncing = False
 
     def __init__(
         self,
@@ -174,8 +175,6 @@ class MainWindow(QMainWindow):
             self._zoom_act.toggled.connect(vw.view.set_zoom)
             vw.view.zoomModeChanged.connect(self._zoom_act.setChecked)
             
-            self.videoFramePanel.set_frame.connect(vw.set_frame)
-
             self.videowindows.append(vw)
             self._mdi_area.addSubWindow(vw)
             vw.show()
@@ -192,7 +191,19 @@ class MainWindow(QMainWindow):
         # handle audio
         isaudio = [vid.is_audio for vid in self.project.videos]
         if all(isaudio):
-            self.videoFramePanel.addAudio(self.videos)
+            self.videoFramePanel.addAudio(self.project.videos)
+
+    @Slot(int)
+    def set_frame(self, fr):
+        # decode all of the cameras in parallel, then update the windows
+        try:
+            frames = self.project.multivideo.get_frame(fr)
+        except Exception as err:
+            logger.error("Couldn't read frame {} from the videos. Error {}".format(fr, err))
+            return
+
+        for vw, img in zip(self.videowindows, frames):
+            vw.show_frame(fr, img)
 
     @Slot(int, str, int, int)
     def selectPoint(self, setnum, camname, frame, id):
@@ -202,26 +213,114 @@ class MainWindow(QMainWindow):
     def setParameterCallbacks(self):
         try:
             self.project.parameters.child('Calibration', 'Calibrate...').sigActivated.connect(self.do_calibrate)
+            self.project.parameters.child('Calibration', 'Refine calibration...').sigActivated.connect(self.do_refine_calibration)
             self.project.parameters.child('Synchronization', 'Synchronize...').sigActivated.connect(self.sync_videos)
+            self.project.parameters.child('Frame proxies', 'Make proxies...').sigActivated.connect(self.make_proxies)
         except KeyError as err:
             logging.debug(f"Error connection parameter slots: {err}")
 
     def sync_videos(self):
         logger.debug('Syncing')
-        if self.parameters['Synchronization', 'Method'] == 'Timecode':
-            logger.debug('Syncing by timecode!')
+        method = self.parameters['Synchronization', 'Method']
+        if method == 'None':
+            return
+
+        try:
+            window = self.parameters['Synchronization', 'Search window']
+        except KeyError:
+            window = 2.0
+
+        if self._syncing:
+            logger.info('Already synchronizing the videos')
+            return
+        self._syncing = True
+
+        self._sync_thread = QThread()
+        self._sync_worker = SyncEstimator(self.project, method, window=window)
+        self._sync_worker.moveToThread(self._sync_thread)
+
+        self._sync_thread.started.connect(self._sync_worker.run)
+        self._sync_worker.finished.connect(self._sync_thread.quit)
+        self._sync_worker.finished.connect(self._sync_worker.deleteLater)
+        self._sync_worker.finished.connect(self._sync_thread.deleteLater)
+
+        self._sync_worker.finished.connect(self.finish_sync)
+
+        self._sync_thread.start()
+
+    @Slot(list, list)
+    def finish_sync(self, offsets, confidences):
+        logger.debug('finish_sync')
+        self._syncing = False
+        if len(offsets) == 0:
+            return
+
+        for cn, off, conf in zip(self.project.camera_names, offsets, confidences):
+            logger.debug(f"{cn}: offset = {off*1000:.1f}ms, confidence = {conf}")
+
+        self.project.show_sync(offsets, confidences)
+        self.project.set_sync_offsets(offsets)
+
+    def make_proxies(self):
+        logger.debug('Making frame proxies')
+        self._proxy_thread = QThread()
+        self._proxy_worker = self.project.make_proxies(scale=self.parameters['Frame proxies', 'Scale'],
+                                                       gray=self.parameters['Frame proxies', 'Grayscale'])
+        self._proxy_worker.moveToThread(self._proxy_thread)
+
+        self._proxy_thread.started.connect(self._proxy_worker.run)
+        self._proxy_worker.finished.connect(self._proxy_thread.quit)
+        self._proxy_worker.finished.connect(self._proxy_worker.deleteLater)
+        self._proxy_worker.finished.connect(self._proxy_thread.deleteLater)
+
+        self._proxy_worker.progress.connect(self.videoControlPanel.show_proxy_progress)
+        self._proxy_worker.finished.connect(self.videoControlPanel.proxies_finished)
+        self._proxy_worker.finished.connect(self.project.use_proxies)
+
+        self._proxy_thread.start()
+
+    def cancel_proxies(self):
+        logger.debug('MainWindow.cancel_proxies')
+        # call directly, since the worker thread is busy and won't get queued signals
+        worker = getattr(self, '_proxy_worker', None)
+        if worker is not None:
+            worker.cancel()
 
     def do_calibrate(self):
         logger.debug('MainWindow.do_calibrate')
 
         camnames = self.project.camera_names
-        sz = self.videos[0].frame_size
+        sz = self.project.videos[0].frame_size
         logger.debug(f"{sz=}")
         
-        self.calibration = Calibration.from_parameters(cameranames=camnames, videos=self.videos, 
+        self.calibration = Calibration.from_parameters(cameranames=camnames, videos=self.project.videos, 
                                             params=self.parameters.child('Calibration'))
-        self.project.add_calibration(self.calibration)
 
+        self._start_calibration(self.calibration.run)
+
+    def do_refine_calibration(self):
+        logger.debug('MainWindow.do_refine_calibration')
+
+        previous = self.project.calibration
+        if previous is None or not previous.calibrated:
+            logger.error("Calibrate before refining the calibration")
+            return
+
+        self.calibration = Calibration.from_parameters(cameranames=self.project.camera_names,
+                                                       videos=self.project.videos,
+                                                       params=self.parameters.child('Calibration'))
+        self.calibration.start_from(previous)
+
+        self._start_calibration(self.calibration.refine)
+
+    def cancel_calibration(self):
+        logger.debug('MainWindow.cancel_calibration')
+        # call directly, since the calibration thread is busy and won't get queued signals
+        calibration = getattr(self, 'calibration', None)
+        if calibration is not None:
+            calibration.cancel()
+
+    def _start_calibration(self, slot):
         if DEBUG_CALIBRATION:
             self._calibration_worker = self.calibration
             
@@ -230,14 +329,14 @@ class MainWindow(QMainWindow):
             self._calibration_worker.finished.connect(self.finish_calibration)
 
             # run the calibration in the main thread so that we can debug more easily
-            self.calibration.run()
+            slot()
 
         else:
             self._calibration_thread = QThread()
             self._calibration_worker = self.calibration
             self._calibration_worker.moveToThread(self._calibration_thread)
 
-            self._calibration_thread.started.connect(self._calibration_worker.run)
+            self._calibration_thread.started.connect(slot)
             self._calibration_worker.finished.connect(self._calibration_thread.quit)
             self._calibration_worker.finished.connect(self._calibration_worker.deleteLater)
             self._calibration_worker.finished.connect(self._calibration_thread.deleteLater)
@@ -251,7 +350,15 @@ class MainWindow(QMainWindow):
     @Slot(list)
     def finish_calibration(self, rows):
         logger.debug('finish_calibration')
-        self.project.add_points(Points.from_calibration_rows(rows, self.calibration))
+        # only keep calibrations whose bundle adjustment finished, so that a cancelled
+        # or failed run doesn't replace the current one
+        if not self.calibration.calibrated:
+            logger.info('Calibration did not finish; keeping the previous calibration')
+            return
+
+        self.project.add_calibration(self.calibration)
+        if all(len(rows_cam) > 0 for rows_cam in rows):
+            self.project.add_points(Points.from_calibration_rows(rows, self.calibration))
 
         # for vw1 in self.videowindows:
         #     vw1.set_points(self.points)
@@ -264,11 +371,14 @@ class MainWindow(QMainWindow):
         self.videoControlPanel.addedVideos.connect(self.project.set_videos)
         self.videoControlPanel.syncVideos.connect(self.sync_videos)
         self.videoControlPanel.doCalibrate.connect(self.do_calibrate)
+        self.videoControlPanel.cancelCalibration.connect(self.cancel_calibration)
+        self.videoControlPanel.cancelProxies.connect(self.cancel_proxies)
 
         self.project.parametersSet.connect(self.videoControlPanel.setParameters)
         self.project.parametersUpdated.connect(self.videoControlPanel.updateParameters)
 
         self.videoFramePanel = VideoFramePanel(self)
+        self.videoFramePanel.set_frame.connect(self.set_frame)
 
     @Slot()
     def update_window_menu(self):
@@ -0,0 +1,254 @@
+import os, sys
+import json
+import subprocess
+import threading
+from fractions import Fraction
+import numpy as np
+from attrs import define, field
+
+import logging
+logger = logging.getLogger('label3d')
+
+# everything that label3d and sync_videos need to know about a file, so that one
+# ffprobe call per file is enough
+PROBE_ENTRIES = ':'.join(['format=duration,bit_rate',
+                          'format_tags=timecode,creation_time',
+                          'stream=index,codec_type,codec_name,width,height,avg_frame_rate,'
+                          'nb_frames,duration,bit_rate,sample_rate,channels',
+                          'stream_tags=timecode,creation_time'])
+
+def user_cache_dir() -> str:
+    """Returns the directory for label3d's per-user cache files."""
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+
+    return os.path.join(base, 'label3d')
+
+def file_key(filename: str) -> tuple:
+    """Returns (path, size, mtime), which changes whenever the file does."""
+    st = os.stat(filename)
+    return (os.path.abspath(filename), st.st_size, st.st_mtime)
+
+def file_fingerprint(filename: str) -> dict:
+    """Returns the size and mtime of a file, to tell if it has changed since."""
+    _, size, mtime = file_key(filename)
+    return {'size': size, 'mtime': mtime}
+
+def load_sidecar(cachefile: str, filename: str):
+    """Loads arrays saved by :func:`save_sidecar`.
+
+    Returns:
+        dict of arrays, or None if the cache file is missing, unreadable, or was
+            saved for a different version of `filename`
+    """
+    if not os.path.isfile(cachefile):
+        return None
+
+    fp = file_fingerprint(filename)
+    try:
+        with np.load(cachefile) as data:
+            if any(data[k] != v for k, v in fp.items()):
+                logger.debug(f"{filename} changed. Ignoring {cachefile}")
+                return None
+            return {k: data[k] for k in data.files if k not in fp}
+    except (OSError, KeyError, ValueError) as err:
+        logger.debug(f"Could not read {cachefile}: {err}")
+        return None
+
+def save_sidecar(cachefile: str, filename: str, **arrays):
+    """Saves arrays computed from `filename` in an .npz file, with its fingerprint."""
+    try:
+        np.savez(cachefile, **arrays, **file_fingerprint(filename))
+    except OSError as err:
+        logger.debug(f"Could not save {cachefile}: {err}")
+
+@define
+class MetadataCache:
+    """Parsed ffprobe output for media files, saved as JSON between sessions.
+
+    Entries are keyed by absolute path and only used if the file's size and
+    modification time haven't changed.
+
+    Args:
+        filename: JSON file to keep the cache in. Defaults to `metadata.json` in
+            :func:`user_cache_dir`.
+    """
+    filename: str = field(factory=lambda: os.path.join(user_cache_dir(), 'metadata.json'))
+
+    _entries: dict = field(default=None)
+    _lock = field(factory=threading.RLock)
+
+    def _load(self):
+        if self._entries is not None:
+            return
+
+        try:
+            with open(self.filename, 'r') as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            self._entries = {}
+        except (OSError, ValueError) as err:
+            logger.debug(f"Could not read metadata cache {self.filename}: {err}")
+            self._entries = {}
+
+    def save(self):
+        with self._lock:
+            if self._entries is None:
+                return
+
+            try:
+                os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+                tmpname = self.filename + '.tmp'
+                with open(tmpname, 'w') as f:
+                    json.dump(self._entries, f)
+                os.replace(tmpname, self.filename)
+            except OSError as err:
+                logger.debug(f"Could not save metadata cache {self.filename}: {err}")
+
+    def get(self, filename: str):
+        """Returns the cached data for a file, or None if it's missing or out of date."""
+        path, size, mtime = file_key(filename)
+
+        with self._lock:
+            self._load()
+            entry = self._entries.get(path)
+
+        if entry is None or entry['size'] != size or entry['mtime'] != mtime:
+            return None
+        return entry['data']
+
+    def put(self, filename: str, data: dict, save=True):
+        path, size, mtime = file_key(filename)
+
+        with self._lock:
+            self._load()
+            self._entries[path] = {'size': size, 'mtime': mtime, 'data': data}
+
+            if save:
+                self.save()
+
+_default_cache = None
+
+def default_cache() -> MetadataCache:
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = MetadataCache()
+    return _default_cache
+
+def _ffprobe(args: list, ffprobe=None) -> subprocess.CompletedProcess:
+    if ffprobe is not None:
+        cmd = [ffprobe] + args
+        logger.debug("Command: {}".format(' '.join(cmd)))
+        return subprocess.run(cmd, capture_output=True, universal_newlines=True)
+    else:
+        import ffmpegio
+        return ffmpegio.path.ffprobe(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                     universal_newlines=True)
+
+def run_ffprobe(filename: str, ffprobe=None) -> dict:
+    """Runs ffprobe on a file, asking only for PROBE_ENTRIES, and returns the parsed JSON.
+
+    Args:
+        filename: Media file to probe
+        ffprobe: Path to the ffprobe executable. If not given, use the one that
+            ffmpegio finds.
+    """
+    r = _ffprobe(['-v', 'error', '-print_format', 'json',
+                  '-show_entries', PROBE_ENTRIES, filename], ffprobe=ffprobe)
+
+    if r.returncode != 0:
+        raise OSError(f"ffprobe failed on {filename}: {r.stderr.strip()}")
+
+    return json.loads(r.stdout)
+
+def probe_video_packets(filename: str, ffprobe=None):
+    """Returns the presentation time of each packet in the first video stream, and
+    whether it's a keyframe.
+
+    Only reads packet headers, so it doesn't need to decode anything.
+
+    Returns:
+        (times, iskey): arrays in presentation order, so that index i is frame i
+
+    Raises:
+        ValueError: if a packet has no presentation time, since then we can't tell
+            which frame it is
+    """
+    r = _ffprobe(['-v', 'error', '-select_streams', 'v:0',
+                  '-show_entries', 'packet=pts_time,flags',
+                  '-of', 'csv=p=0', filename], ffprobe=ffprobe)
+
+    if r.returncode != 0:
+        raise OSError(f"ffprobe failed on {filename}: {r.stderr.strip()}")
+
+    times = []
+    iskey = []
+    for line in r.stdout.splitlines():
+        parts = line.split(',')
+        if len(parts) < 2:
+            continue
+        if parts[0] == 'N/A':
+            raise ValueError(f"Packets without timestamps in {filename}")
+        times.append(float(parts[0]))
+        iskey.append('K' in parts[1])
+
+    # packets are listed in decode order, so sort them by presentation time
+    times = np.array(times)
+    order = np.argsort(times, kind='stable')
+    return times[order], np.array(iskey, dtype=bool)[order]
+
+def probe_file(filename: str, cache=True, ffprobe=None) -> dict:
+    """Returns ffprobe data for a file, from the metadata cache if possible.
+
+    Args:
+        filename: Media file to probe
+        cache: True to use :func:`default_cache`, a :class:`MetadataCache`, or
+            False/None to always run ffprobe
+        ffprobe: Path to the ffprobe executable (see :func:`run_ffprobe`)
+    """
+    if not os.path.isfile(filename):
+        raise FileNotFoundError(f"Could not find file {filename}")
+
+    if cache is True:
+        cache = default_cache()
+
+    if cache:
+        data = cache.get(filename)
+        if data is not None:
+            return data
+
+    data = run_ffprobe(filename, ffprobe=ffprobe)
+
+    if cache:
+        cache.put(filename, data)
+
+    return data
+
+def streams_of_type(data: dict, codec_type: str) -> list:
+    return [s for s in data.get('streams', []) if s.get('codec_type') == codec_type]
+
+def video_info(data: dict) -> dict:
+    """Pulls basic information about the first video stream out of ffprobe data.
+
+    Returns:
+        dict with 'width', 'height', 'fps', and 'nframes'
+    """
+    streams = streams_of_type(data, 'video')
+    if len(streams) == 0:
+        raise KeyError("No video stream found")
+    stream = streams[0]
+
+    fps = float(Fraction(stream['avg_frame_rate']))
+    try:
+        nframes = int(stream['nb_frames'])
+    except (KeyError, ValueError):
+        # some containers don't store the number of frames
+        duration = stream.get('duration', data.get('format', {}).get('duration'))
+        nframes = int(round(float(duration) * fps))
+
+    return {'width': int(stream['width']), 'height': int(stream['height']),
+            'fps': fps, 'nframes': nframes}
@@ -9,6 +9,9 @@ from string import ascii_uppercase
 from datetime import datetime
 import tomlkit
 from collections.abc import Iterable
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import logging
 logger = logging.getLogger('label3d')
@@ -19,9 +22,13 @@ from qtpy.QtCore import (
     Slot,
 )
 
-from videofile import Video
+from videofile import Video, MultiVideo, MediaVideo, FrameProxy
+from audio import audio_offsets, resample_envelopes
 from points import Points
-from settings import VERSION
+from settings import VERSION, READAHEAD_FRAMES
+
+# report progress making a proxy every this many frames
+PROXY_PROGRESS_FRAMES = 100
 
 def dict_to_toml(d, tab):
     
@@ -120,12 +127,99 @@ def toml_to_parameters(tab):
     
     return params
 
+class ProxiesCancelled(Exception):
+    pass
+
+class ProxyMaker(QObject):
+    """Decodes videos into frame proxies, to run in a worker thread.
+
+    Each video is decoded with its own reader, so the videos can still be read
+    while the proxies are made.
+
+    Args:
+        videofiles: Videos to decode
+        proxyfiles: Proxy file to write for each video
+        scale: Factor to resize frames by
+        gray: Store grayscale frames
+    """
+    # video number, frame, number of frames in the video
+    progress = QtCore.Signal(int, int, int)
+    # proxy files that were finished
+    finished = QtCore.Signal(list)
+
+    def __init__(self, videofiles, proxyfiles, scale=None, gray=False):
+        super().__init__()
+        self.videofiles = videofiles
+        self.proxyfiles = proxyfiles
+        self.scale = scale
+        self.gray = gray
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        """Stops after the current frame. Safe to call from any thread."""
+        self._cancel.set()
+
+    @Slot()
+    def run(self):
+        done = []
+        try:
+            for vnum, (videofile, proxyfile) in enumerate(zip(self.videofiles, self.proxyfiles)):
+                logger.debug(f"Making proxy {proxyfile} for {videofile}")
+                reader = MediaVideo(filename=videofile, cache_size=0, use_keyframe_index=False)
+                try:
+                    FrameProxy.create(reader, proxyfile, scale=self.scale, gray=self.gray,
+                                      progress=partial(self._progress, vnum))
+                finally:
+                    reader.close()
+                done.append(proxyfile)
+        except ProxiesCancelled:
+            logger.info('Cancelled making proxies')
+        except Exception as err:
+            logger.error(f"Could not make proxies: {err}")
+        finally:
+            self.finished.emit(done)
+
+    def _progress(self, vnum, idx, nframes):
+        if self._cancel.is_set():
+            raise ProxiesCancelled()
+
+        # don't flood the GUI thread with signals
+        if idx % PROXY_PROGRESS_FRAMES == 0 or idx == nframes - 1:
+            self.progress.emit(vnum, idx + 1, nframes)
+
+class SyncEstimator(QObject):
+    """Runs :meth:`Project.estimate_sync` in a worker thread.
+
+    The first audio estimate streams every audio track through ffmpeg, which can
+    take minutes for long recordings.
+    """
+    # offsets and confidences, or empty lists if the estimate failed
+    finished = QtCore.Signal(list, list)
+
+    def __init__(self, project, method='Timecode', window=2.0):
+        super().__init__()
+        self.project = project
+        self.method = method
+        self.window = window
+
+    @Slot()
+    def run(self):
+        offsets, confidences = [], []
+        try:
+            offsets, confidences = self.project.estimate_sync(self.method, window=self.window)
+        except Exception as err:
+            logger.error(f"Could not synchronize videos by {self.method}: {err}")
+        finally:
+            self.finished.emit(list(offsets), list(confidences))
+
 class Project(QObject):
     parametersSet = QtCore.Signal(Parameter)
     parametersUpdated = QtCore.Signal()
     pointsUpdated = QtCore.Signal()
     calibrationSet = QtCore.Signal()
     videosUpdated = QtCore.Signal()
+    # probe generation, camera name, video info, whether to add the info
+    videoProbed = QtCore.Signal(int, str, list, bool)
 
     def __init__(self):
         super(Project, self).__init__()
@@ -134,9 +228,18 @@ class Project(QObject):
         self.videofiles = None
         self._params = []
         self._points = None
+        self.videos = []
+        self.multivideo = None
+        self._nprobing = 0
+        # counts calls to _set_videos_only, so results from older probes are ignored
+        self._probe_generation = 0
+        self._offset_params = []
 
         self.calibration = None
 
+        # results from the probe threads come back to the GUI thread through this
+        self.videoProbed.connect(self._video_probed)
+
     @property
     def filename(self):
         return self._filename
@@ -167,17 +270,87 @@ class Project(QObject):
         
         return vn
 
-    def _set_videos_only(self, videofiles, cameranames):
+    def proxy_filename(self, videofile):
+        """Where to keep the frame proxy for a video.
+
+        Proxies go next to the video, like the other sidecar files, so that they
+        are found whether or not the project has been saved.
+        """
+        return videofile + '.proxy.npy'
+
+    def _set_videos_only(self, videofiles, cameranames, add_info=False):
+        """Opens the videos and probes them all in parallel.
+
+        Each video's information is added to the parameter tree as its probe
+        finishes, if `add_info` is True. `videosUpdated` is emitted once all of the
+        probes are done.
+        """
+        # stop reading from the old videos before replacing them, so that their
+        # read-ahead threads and captures don't outlive them
+        if self.multivideo is not None:
+            self.multivideo.close()
+        for vid in self.videos:
+            vid.close()
+
         self.videofiles = videofiles
         self.videos = []
-        nfr = []
         for i, (f, cn) in enumerate(zip(videofiles, cameranames)):
-            vid = Video.from_media(f)
-            nfr1 = vid.nframes
-            nfr.append(nfr1)
-
+            vid = Video.from_media(f, readahead=READAHEAD_FRAMES,
+                                   proxy_file=self.proxy_filename(f))
             self.videos.append(vid)
 
+        self.multivideo = MultiVideo(self.videos)
+
+        self._probe_generation += 1
+        self._nprobing = len(self.videos)
+        if self._nprobing == 0:
+            self.videosUpdated.emit()
+            return
+
+        pool = ThreadPoolExecutor(max_workers=min(len(self.videos), 16),
+                                  thread_name_prefix='ProbeVideo')
+        for vid, cn in zip(self.videos, cameranames):
+            fut = pool.submit(self._probe_video, vid)
+            fut.add_done_callback(partial(self._emit_video_probed, self._probe_generation,
+                                          cn, add_info))
+        # the keyframe indexes take longer, so build them after all of the probes
+        for vid in self.videos:
+            pool.submit(vid.build_keyframe_index)
+        pool.shutdown(wait=False)
+
+    @staticmethod
+    def _probe_video(vid):
+        # runs in a worker thread. Reading nframes and the info fills in the video's
+        # metadata, so nothing needs to probe it again on the GUI thread
+        nfr = vid.nframes
+        logger.debug(f"{vid.filename}: nframes = {nfr}")
+
+        info = [{'name': 'Number of frames', 'type': 'int', 'value': nfr, 'readonly': True}]
+        info.extend(vid.get_info_as_parameters())
+        return info
+
+    def _emit_video_probed(self, generation, cameraname, add_info, future):
+        try:
+            info = future.result()
+        except Exception as err:
+            logger.error(f"Could not probe video for {cameraname}: {err}")
+            info = []
+
+        self.videoProbed.emit(generation, cameraname, info, add_info)
+
+    @Slot(int, str, list, bool)
+    def _video_probed(self, generation, cameraname, info, add_info):
+        if generation != self._probe_generation:
+            # the videos were set again while this one was being probed
+            return
+
+        if add_info and len(info) > 0:
+            self.add_video_info(cameraname, info)
+
+        self._nprobing -= 1
+        if self._nprobing == 0:
+            self.videosUpdated.emit()
+
     @Slot(list)
     def set_videos(self, videofiles):
         cameranames = []
@@ -185,8 +358,6 @@ class Project(QObject):
         for i in range(len(videofiles)):
             cameranames.append(f"cam{camletter[i]}")
         
-        self._set_videos_only(videofiles, cameranames)
-
         cams = []
         for i, (fn1, camname1) in enumerate(zip(videofiles, cameranames)):
             cams1 = {'name': camname1, 'type': 'group', 'children': [
@@ -200,6 +371,8 @@ class Project(QObject):
             p.append({'name': 'Synchronization', 'type': 'group', 'children': [
                 {'name': 'Method', 'type': 'list', 'limits': ['None', 'Timecode', 'Audio', 'Timecode+Audio'],
                     'value': 'Timecode'},
+                {'name': 'Search window', 'type': 'float', 'value': 2.0, 'suffix': 's',
+                    'tip': "For Timecode+Audio, how far from the timecode offset to look for the audio match"},
                 {'name': 'Synchronize...', 'type': 'action'},
                 ]})
                                                 
@@ -208,39 +381,180 @@ class Project(QObject):
                     'value': 'Charuco'},
                 {'name': 'Frame Step', 'type': 'int', 'value': 40,  
                     'tip': "Calibrate on every nth frame"},
+                {'name': 'Detection processes', 'type': 'int', 'value': 0, 'limits': (0, None),
+                    'tip': "Number of processes to look for the board in. 0 uses one per core"},
+                {'name': 'Reuse detections', 'type': 'bool', 'value': True,
+                    'tip': "Keep the boards found in each video and only search new frames next time"},
+                {'name': 'Coarse detection width', 'type': 'int', 'value': 960, 'limits': (0, None), 'suffix': 'px',
+                    'tip': "Look for markers in frames shrunk to this width first, and skip frames without any. 0 turns this off"},
+                {'name': 'Max calibration frames', 'type': 'int', 'value': 200, 'limits': (0, None),
+                    'tip': "Number of frames with the most varied board positions to use for bundle adjustment. 0 uses all of them"},
+                {'name': 'Blur threshold', 'type': 'float', 'value': 0.5, 'limits': (0, 1),
+                    'tip': "Skip frames less than this fraction as sharp as the median frame. 0 keeps every frame"},
                 {'name': 'Number of squares horizontally', 'type': 'int', 'value': 6},
                 {'name': 'Number of squares vertically', 'type': 'int', 'value': 6},
                 {'name': 'Size of square', 'type': 'float', 'value':24.33, 'suffix': 'mm'},
                 {'name': 'Size of marker', 'type': 'float', 'value':17, 'suffix': 'mm'},
                 {'name': 'Marker bits', 'type': 'int', 'value':5, 'tip':'Information bits in the markers'},
                 {'name': 'Number of markers', 'type': 'int', 'value':50, 'tip':'Number of markers in the dictionary'},
+                {'name': 'Refine with', 'type': 'list', 'limits': ['Selected frames', 'New frames', 'Subsample'],
+                    'value': 'Selected frames',
+                    'tip': "Frames to bundle adjust when refining: the ones used last time, those plus new ones, or a new selection"},
                 {'name': 'Calibrate...', 'type': 'action'},
                 {'name': 'Refine calibration...', 'type': 'action'}
                 ]})
+
+        p.append({'name': 'Frame proxies', 'type': 'group', 'children': [
+            {'name': 'Scale', 'type': 'float', 'value': 1.0, 'limits': (0.05, 1.0),
+                'tip': "Resize proxy frames by this factor"},
+            {'name': 'Grayscale', 'type': 'bool', 'value': False},
+            {'name': 'Make proxies...', 'type': 'action',
+                'tip': "Decode every frame to disk for fast random access"},
+            ]})
         
+        self._offset_params = []
         self._params = Parameter.create(name='Parameters', type='group', children=p)
-
-        for i, (vid1, cn) in enumerate(zip(self.videos, cameranames)):
-            nfr1 = vid1.nframes
-
-            logger.debug(f"{vid1.filename}: nframes = {nfr1}")
-            self.add_video_info(cn, [{'name': 'Number of frames', 'type': 'int', 'value': nfr1, 'readonly': True}])
-            
-            info = vid1.get_info_as_parameters()
-            if len(info) > 0:
-                self.add_video_info(cn, info)
-
         self.parametersSet.emit(self._params)
-        self.videosUpdated.emit()
+
+        # the video information fills in as each probe finishes
+        self._set_videos_only(videofiles, cameranames, add_info=True)
 
     def add_action_parameters(self):
         self.parameters.child('Calibration').addChild({'name': 'Calibrate...', 'type': 'action'}, existOk=True)
         self.parameters.child('Calibration').addChild({'name': 'Refine calibration...', 'type': 'action'}, existOk=True)
         self.parameters.child('Synchronization').addChild({'name': 'Synchronize...', 'type': 'action'}, existOk=True)
+        try:
+            self.parameters.child('Frame proxies').addChild({'name': 'Make proxies...', 'type': 'action'}, existOk=True)
+        except KeyError:
+            # older projects don't have proxy parameters
+            pass
 
     def add_videos(self, videofiles, cameranames=None):
         raise NotImplementedError("Can't add videofiles to the project yet")
 
+    def make_proxies(self, scale=None, gray=False) -> ProxyMaker:
+        """Returns a :class:`ProxyMaker` for every video, to run in a worker thread.
+
+        Pass the finished proxy files to :meth:`use_proxies` to start reading from them.
+        """
+        if scale == 1:
+            scale = None
+
+        videofiles = [vid.filename for vid in self.videos]
+        proxyfiles = [self.proxy_filename(f) for f in videofiles]
+        return ProxyMaker(videofiles, proxyfiles, scale=scale, gray=gray)
+
+    @Slot(list)
+    def use_proxies(self, proxyfiles):
+        """Reads frames from these proxy files from now on."""
+        for vid in self.videos:
+            proxyfile = self.proxy_filename(vid.filename)
+            if proxyfile in proxyfiles:
+                vid.use_proxy(proxyfile)
+
+    def estimate_sync(self, method='Timecode', window=2.0):
+        """Estimates how much later events happen in each video than in the first one.
+
+        Args:
+            method: 'Timecode', 'Audio', or 'Timecode+Audio'. For 'Timecode+Audio',
+                the audio match is only searched for within `window` seconds of
+                the timecode estimate.
+            window: Search window in seconds for 'Timecode+Audio'
+
+        Returns:
+            (offsets, confidences): offsets in seconds for each video, and the
+                audio correlation for each video against the first one (None for
+                'Timecode')
+        """
+        centers = None
+        if method in ('Timecode', 'Timecode+Audio'):
+            timecodes = [vid.get_timecode() for vid in self.videos]
+            if any(tc is None for tc in timecodes):
+                raise ValueError("Not all of the videos have timecodes")
+
+            # a video that started later sees the same event at an earlier time
+            centers = [(timecodes[0] - tc).total_seconds() for tc in timecodes]
+
+        if method == 'Timecode':
+            return centers, [None] * len(self.videos)
+        elif method == 'Audio':
+            window = None
+        elif method != 'Timecode+Audio':
+            raise ValueError(f"Unknown synchronization method {method}")
+
+        if not all(vid.is_audio for vid in self.videos):
+            raise ValueError("Not all of the videos have audio")
+
+        # each envelope comes from its own ffmpeg process, so read them in parallel
+        with ThreadPoolExecutor(max_workers=min(len(self.videos), 16)) as pool:
+            audio = list(pool.map(lambda vid: vid.audio(), self.videos))
+
+        # cameras recording at 44.1 and 48 kHz give envelopes at different rates
+        rate, envelopes = resample_envelopes([env for _, env in audio],
+                                             [rate for rate, _ in audio])
+        return audio_offsets(envelopes, rate, centers=centers, window=window)
+
+    def set_video_value(self, cameraname, info):
+        """Sets the value of a video parameter, adding it if it isn't there yet."""
+        vidparams = self._params.child('Videos', cameraname)
+        try:
+            vidparams.child(info['name']).setValue(info['value'])
+        except KeyError:
+            vidparams.addChild(info)
+        self.parametersUpdated.emit()
+
+    def set_sync_offsets(self, offsets):
+        """Synchronizes the videos at read time, without reencoding anything.
+
+        Args:
+            offsets: Offset of each video in seconds, as from :meth:`estimate_sync`.
+                Frame 0 of the project becomes the first frame that all of the
+                videos have.
+        """
+        frames = [off * vid.fps for off, vid in zip(offsets, self.videos)]
+        first = min(frames)
+        self.set_frame_offsets([int(round(fr - first)) for fr in frames])
+
+    def set_frame_offsets(self, frame_offsets):
+        for vid, cn, off in zip(self.videos, self.camera_names, frame_offsets):
+            vid.offset = int(off)
+            self.set_video_value(cn, {'name': 'Frame offset', 'type': 'int', 'value': int(off),
+                                      'limits': (0, None),
+                                      'tip': "Frame in the file that is frame 0 of the project"})
+
+        self._connect_frame_offsets()
+        self.videosUpdated.emit()
+
+    def _connect_frame_offsets(self):
+        """Applies the 'Frame offset' parameters to the videos and follows any edits."""
+        for vid, cn in zip(self.videos, self.camera_names):
+            try:
+                p = self._params.child('Videos', cn, 'Frame offset')
+            except KeyError:
+                continue
+
+            # projects saved before offsets had limits could have negative ones
+            p.setLimits((0, None))
+            if p.value() < 0:
+                p.setValue(0)
+            vid.offset = int(p.value())
+            if not any(p is p1 for p1 in self._offset_params):
+                p.sigValueChanged.connect(partial(self._frame_offset_changed, vid))
+                self._offset_params.append(p)
+
+    def _frame_offset_changed(self, vid, param, value):
+        if vid.offset != int(value):
+            vid.offset = int(value)
+            self.videosUpdated.emit()
+
+    def show_sync(self, offsets, confidences):
+        for cn, off, conf in zip(self.camera_names, offsets, confidences):
+            self.set_video_value(cn, {'name': 'Sync offset', 'type': 'float', 'value': off,
+                                      'suffix': 's', 'readonly': True})
+            if conf is not None:
+                self.set_video_value(cn, {'name': 'Sync confidence', 'type': 'float',
+                                          'value': conf, 'readonly': True})
+
     def add_video_info(self, cameraname, info):
         self._params.child('Videos', cameraname).addChildren(info)
         self.parametersUpdated.emit()
@@ -280,12 +594,14 @@ class Project(QObject):
         self.add_action_parameters()
         self.parametersSet.emit(self._params)
 
+        self._offset_params = []
         self._set_videos_only(self.video_files, self.camera_names)
+        self._connect_frame_offsets()
 
         pts = doc['Points']
         self._points = pd.DataFrame.from_dict(pts, orient='tight')
 
-        self.videosUpdated.emit()
+        # videosUpdated is emitted when the videos have all been probed
         # self.pointsUpdated.emit()
 
     def save(self, overwrite=False):
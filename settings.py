@@ -2,3 +2,6 @@ SETTINGS_FILE = 'label3d.ini'
 DEBUG_CALIBRATION = False
 VERSION = '0.0.1'
 
+
+# frames to decode ahead of the current one while playing forward
+READAHEAD_FRAMES = 8
@@ -1,13 +1,17 @@
 import os, sys
 import argparse
 import logging
-import json
 import subprocess
 import numpy as np
 from datetime import datetime, time, timedelta
 import re
+import tempfile
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from functools import total_ordering
 
+from mediainfo import probe_file, probe_video_packets
+
 if sys.platform == 'darwin':
     FFPROBE = '/opt/homebrew/bin/ffprobe'
     FFMPEG = '/opt/homebrew/bin/ffmpeg'
@@ -22,6 +26,12 @@ if not os.path.exists(FFPROBE):
 if not os.path.exists(FFMPEG):
     raise(OSError("Could not find ffmpeg at path {}".format(FFMPEG)))
 
+def positive_int(value):
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, not {}".format(value))
+    return n
+
 def build_parser():
     parser = argparse.ArgumentParser(
                         prog='sync_videos',
@@ -47,8 +57,200 @@ def build_parser():
                         default="span")
     parser.add_argument('-n', '--dry_run', help="Just display information but don't do the encoding",
                         default=False, action='store_true')
+    parser.add_argument('-j', '--jobs', help="Number of encodes to run at the same time (default: one per file, up to the number of cores)",
+                        type=positive_int, default=None)
+    parser.add_argument('--threads', help="Number of ffmpeg threads for each encode (default: cores divided by jobs)",
+                        type=int, default=None)
+    parser.add_argument('--cut', help="How to trim the videos. 'auto' stream copies when the start lands on a keyframe and "
+                        "otherwise only reencodes up to the next keyframe; 'reencode' always reencodes the whole video",
+                        choices=['auto', 'reencode'], default='auto')
+    parser.add_argument('--keyframe_tolerance', help="How close (in frames) the start has to be to a keyframe to just stream copy",
+                        type=float, default=0.5)
+    parser.add_argument('--editlist', help="Stream copy from the keyframe before the start, and use an MP4 edit list to skip "
+                        "the extra frames. Not all programs respect edit lists",
+                        default=False, action='store_true')
     return parser
 
+# encoders that produce the same kind of stream as the source codec, for smart cuts
+SMART_CUT_ENCODERS = {'h264': 'libx264', 'hevc': 'libx265'}
+
+def plan_trim(keytimes, start, fps, tolerance=0.5, allow_editlist=False):
+    """Decides how to cut a video so that it starts at `start`.
+
+    Args:
+        keytimes: Presentation times of the keyframes, in seconds
+        start: Time of the first frame to keep
+        fps: Frame rate
+        tolerance: Maximum distance in frames from `start` to a keyframe to cut there
+        allow_editlist: If True, stream copy from the previous keyframe and rely on
+            an edit list to hide the extra frames
+
+    Returns:
+        (method, time): 'copy' and the keyframe time to cut at, 'editlist' and
+            `start`, 'smart' and the time of the first keyframe after `start`, or
+            'reencode' and `start`
+    """
+    keytimes = np.asarray(keytimes)
+    if len(keytimes) == 0:
+        return 'reencode', start
+
+    k = np.argmin(np.abs(keytimes - start))
+    if abs(keytimes[k] - start) * fps <= tolerance:
+        return 'copy', float(keytimes[k])
+
+    if allow_editlist:
+        return 'editlist', start
+
+    after = keytimes[keytimes > start]
+    if len(after) > 0:
+        return 'smart', float(after[0])
+
+    return 'reencode', start
+
+def format_time(t):
+    hours, rem = divmod(t, 3600)
+    minutes, seconds = divmod(rem, 60)
+    return '{:d}:{:02d}:{:09.6f}'.format(int(hours), int(minutes), seconds)
+
+class EncodeJob:
+    """The ffmpeg runs that make one output file, with their progress parsed from
+    ffmpeg's -progress output.
+
+    Args:
+        name: Name to show in the progress report
+        steps: List of (command, nframes) pairs to run in order
+        tempfiles: Intermediate files to delete once all of the steps are done
+    """
+    def __init__(self, name, steps, tempfiles=None):
+        self.name = name
+        self.steps = steps
+        self.tempfiles = tempfiles if tempfiles is not None else []
+
+        self.frame = 0
+        self.returncode = None
+        self.error = ''
+        self.start_time = None
+        self.end_time = None
+
+    @property
+    def nframes(self):
+        return sum(nfr for _, nfr in self.steps)
+
+    @property
+    def done(self):
+        return self.returncode is not None
+
+    def run(self):
+        self.start_time = monotonic()
+
+        nfinished = 0
+        for cmd, nfr in self.steps:
+            self.returncode = None
+            returncode = self._run_step(cmd, nfinished)
+            if returncode != 0:
+                break
+            nfinished += nfr
+            self.frame = nfinished
+
+        for f in self.tempfiles:
+            if os.path.exists(f):
+                os.remove(f)
+
+        self.end_time = monotonic()
+        self.returncode = returncode
+        return self.returncode
+
+    def _run_step(self, cmd, nfinished):
+        # ffmpeg writes key=value progress lines to stdout. Send stderr to a file so
+        # that a chatty encode can't fill the pipe and stall
+        cmd = cmd[:1] + ['-nostats', '-progress', 'pipe:1'] + cmd[1:]
+        logging.debug("Command: {}".format(' '.join(cmd)))
+
+        with tempfile.TemporaryFile(mode='w+') as errfile:
+            try:
+                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errfile,
+                                        stdin=subprocess.DEVNULL, universal_newlines=True)
+            except OSError as err:
+                self.error = str(err)
+                return -1
+
+            for line in proc.stdout:
+                key, _, value = line.strip().partition('=')
+                if key == 'frame':
+                    try:
+                        self.frame = nfinished + int(value)
+                    except ValueError:
+                        pass
+
+            proc.wait()
+
+            errfile.seek(0)
+            self.error = errfile.read()
+
+        return proc.returncode
+
+def format_duration(seconds):
+    if seconds is None or not np.isfinite(seconds):
+        return '--:--:--'
+    hours, rem = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(rem, 60)
+    return '{:d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+def show_progress(jobs, start_time):
+    total = sum(job.nframes for job in jobs)
+    done = sum(min(job.frame, job.nframes) for job in jobs)
+    elapsed = monotonic() - start_time
+
+    if done > 0:
+        eta = (total - done) * elapsed / done
+    else:
+        eta = None
+
+    nrunning = sum(1 for job in jobs if job.start_time is not None and not job.done)
+    nfinished = sum(1 for job in jobs if job.done)
+
+    pct = 100 * done / total if total > 0 else 100
+    print("\r{:5.1f}% ({}/{} frames), {} running, {}/{} finished. Elapsed {}, ETA {}   "\
+          .format(pct, done, total, nrunning, nfinished, len(jobs),
+                  format_duration(elapsed), format_duration(eta)),
+          end='', flush=True)
+
+def run_jobs(jobs, njobs, update_interval=1.0):
+    """Runs encodes concurrently, showing overall progress, and reports failures.
+
+    Returns:
+        List of the jobs that failed
+    """
+    start_time = monotonic()
+    with ThreadPoolExecutor(max_workers=njobs) as pool:
+        futures = {pool.submit(job.run): job for job in jobs}
+        pending = set(futures)
+        while len(pending) > 0:
+            _, pending = wait(pending, timeout=update_interval, return_when=FIRST_COMPLETED)
+            show_progress(jobs, start_time)
+    print()
+
+    for future, job in futures.items():
+        err = future.exception()
+        if err is not None:
+            # the job raised rather than ffmpeg failing, for example removing a temp file
+            job.returncode = -1
+            job.error = "{}: {}".format(type(err).__name__, err)
+            if job.end_time is None:
+                job.end_time = monotonic()
+
+    failed = [job for job in jobs if job.returncode != 0]
+    for job in jobs:
+        dur = format_duration(job.end_time - job.start_time)
+        if job.returncode == 0:
+            print("{}: done in {}".format(job.name, dur))
+        else:
+            print("{}: FAILED after {} with exit code {}".format(job.name, dur, job.returncode))
+            for line in job.error.strip().splitlines()[-10:]:
+                print("    {}".format(line))
+
+    return failed
+
 @total_ordering
 class VideoTimeData:
     def __init__(self, filename):
@@ -66,14 +268,8 @@ class VideoTimeData:
             self.audiobitrate = float(self.audio_stream['bit_rate'])
 
     def _get_file_data(self, filename):
-        cmd = [FFPROBE, '-print_format', 'json',
-            '-show_format', '-show_streams',
-                filename]
-        logging.debug("Command: {}".format(' '.join(cmd)))
-        r = subprocess.run(cmd, capture_output=True)
-
-        dat = json.loads(r.stdout)
-        return(dat)
+        # only asks ffprobe for the entries we need, and shares the cache with label3d
+        return probe_file(filename, ffprobe=FFPROBE)
 
     def _get_video_stream(self):
         for s in self.file_data['streams']:
@@ -140,7 +336,9 @@ def main():
     parser = build_parser()
     args = parser.parse_args()
 
-    timedata = [VideoTimeData(f) for f in args.files[0]]
+    # probing is mostly waiting on ffprobe, so do all of the files at once
+    with ThreadPoolExecutor(max_workers=max(1, len(args.files[0]))) as pool:
+        timedata = list(pool.map(VideoTimeData, args.files[0]))
     timedata = sorted(timedata, reverse=True)
 
     tc = np.array([td.timecode for td in timedata])
@@ -161,7 +359,15 @@ def main():
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
 
-    for f1, td1, tc1, endfr1 in zip(args.files[0], timedata, tc, endfr):
+    ncores = os.cpu_count() or 1
+    njobs = args.jobs if args.jobs is not None else max(1, min(len(timedata), ncores))
+    # split the cores between the jobs, so that they don't oversubscribe the machine
+    nthreads = args.threads if args.threads is not None else max(1, ncores // njobs)
+
+    jobs = []
+    for td1, tc1, endfr1 in zip(timedata, tc, endfr):
+        # timedata is sorted by timecode, so take the file name from it
+        f1 = td1.filename
         off = tc1 - tc[0]
         offframes = off.total_seconds() * fps
 
@@ -182,51 +388,149 @@ def main():
                 logging.warning("Output file {} exists. Stopping".format(outf1))
                 break
 
-            cmd = [FFMPEG]
+            start = (-off + timedelta(seconds=1/fps)).total_seconds()
 
-            if args.overwrite:
-                cmd.append('-y')
-            else:
-                cmd.append('-n')
-
-            off = -off + timedelta(seconds=1/fps)
-            hours, rem = divmod(off.seconds, 3600)
-            minutes, seconds = divmod(rem, 60)
-            # If you want to take into account fractions of a second
-            msec = int(off.microseconds / 1e3)
-
-            cmd.extend(['-ss', '{}:{}:{}.{:03d}'.format(hours, minutes, seconds, msec),
-                   '-i', f1, 
-                   '-c:v', args.codec_video,
-                   '-preset', args.preset,
-                   '-b:v', str(td1.bitrate)])
-            
             if args.nframes == 'span':
-                cmd.extend(['-vframes', str(int(minframes))])
+                nfr1 = int(minframes)
             elif args.nframes == 'all':
-                pass
+                nfr1 = int(td1.nframes + offframes)
             else:
                 try:
-                    nfr = int(args.nframes)
-                    cmd.extend(['-vframes', args.nframes])
+                    nfr1 = int(args.nframes)
                 except ValueError:
                     logging.error("Cannot parse number of frames option {}".format(args.nframes))
                     raise ValueError("Cannot parse number of frames option {}".format(args.nframes))
-            
-            if args.codec_video == "libx265":
-                cmd.extend(['-vtag', 'hvc1'])
 
-            if td1.audio_stream is not None:
-                cmd.extend(['-c:a', args.codec_audio,
-                            '-b:a', str(td1.audiobitrate)])
+            if args.cut == 'auto':
+                times, iskey = probe_video_packets(f1, ffprobe=FFPROBE)
+                # packet times are absolute, but -ss counts from the start of the file
+                if len(times) > 0:
+                    times = times - times[0]
+                method, cuttime = plan_trim(times[iskey], start, fps,
+                                            tolerance=args.keyframe_tolerance,
+                                            allow_editlist=args.editlist)
+                if method == 'smart' and td1.video_stream['codec_name'] not in SMART_CUT_ENCODERS:
+                    logging.info("Cannot smart cut {} video. Reencoding".format(td1.video_stream['codec_name']))
+                    method, cuttime = 'reencode', start
             else:
-                cmd.extend(['-an'])
-            
-            cmd.append(outf1)
+                method, cuttime = 'reencode', start
+
+            print("    {} from {}".format(method, format_time(cuttime)))
+
+            overwrite = '-y' if args.overwrite else '-n'
+            tempfiles = []
+
+            if method in ('copy', 'editlist'):
+                if method == 'editlist':
+                    # the frames between the keyframe and the start are copied too and
+                    # hidden by the edit list, but they count toward -frames:v
+                    before = times[iskey & (times <= start)]
+                    nfr1 += int(round((start - before[-1]) * fps)) if len(before) > 0 else 0
+
+                # seek half a frame past the keyframe, so that rounding can't put us
+                # before it and pull in the previous GOP
+                seektime = cuttime + 0.5/fps if method == 'copy' else cuttime
+
+                cmd = [FFMPEG, overwrite,
+                       '-ss', format_time(seektime),
+                       '-i', f1,
+                       '-map', '0:v:0', '-map', '0:a?',
+                       '-c', 'copy',
+                       '-frames:v', str(nfr1)]
+                if method == 'editlist':
+                    cmd.extend(['-use_editlist', '1'])
+                cmd.append(outf1)
+
+                steps = [(cmd, nfr1)]
+
+            elif method == 'smart':
+                # reencode the frames up to the next keyframe, stream copy the rest, and
+                # join them. The pieces are MPEG-TS so that each one carries its own
+                # codec parameters and they can be joined with the concat protocol
+                codec = td1.video_stream['codec_name']
+                nhead = int(round((cuttime - start) * fps))
+
+                tmpdir = os.path.dirname(os.path.abspath(outf1))
+                nm = os.path.splitext(os.path.basename(outf1))[0]
+                headf = os.path.join(tmpdir, nm + '-head.ts')
+                tailf = os.path.join(tmpdir, nm + '-tail.ts')
+                tempfiles = [headf, tailf]
+
+                headcmd = [FFMPEG, '-y',
+                           '-threads', str(nthreads),
+                           '-ss', format_time(start),
+                           '-i', f1,
+                           '-threads', str(nthreads),
+                           '-an',
+                           '-c:v', SMART_CUT_ENCODERS[codec],
+                           '-preset', args.preset,
+                           '-b:v', str(td1.bitrate),
+                           '-frames:v', str(nhead),
+                           '-bsf:v', codec + '_mp4toannexb',
+                           headf]
+                tailcmd = [FFMPEG, '-y',
+                           '-ss', format_time(cuttime + 0.5/fps),
+                           '-i', f1,
+                           '-an',
+                           '-c:v', 'copy',
+                           '-frames:v', str(max(nfr1 - nhead, 0)),
+                           '-bsf:v', codec + '_mp4toannexb',
+                           tailf]
+
+                # take the audio straight from the source, cut at the start time
+                joincmd = [FFMPEG, overwrite,
+                           '-i', 'concat:{}|{}'.format(headf, tailf),
+                           '-ss', format_time(start), '-i', f1,
+                           '-map', '0:v:0', '-map', '1:a?',
+                           '-c', 'copy',
+                           '-t', '{:.6f}'.format(nfr1 / fps)]
+                # the reencoded head and the copied tail have different parameter
+                # sets, which hvc1 and avc1 don't allow in band
+                if codec == 'hevc':
+                    joincmd.extend(['-tag:v', 'hev1'])
+                elif codec == 'h264':
+                    joincmd.extend(['-tag:v', 'avc3'])
+                joincmd.append(outf1)
+
+                steps = [(headcmd, nhead), (tailcmd, max(nfr1 - nhead, 0)), (joincmd, nfr1)]
 
-            logging.debug("Command: {}".format(' '.join(cmd)))
-            if not args.dry_run:
-                r = subprocess.run(cmd)
+            else:
+                cmd = [FFMPEG, overwrite,
+                       '-threads', str(nthreads),
+                       '-ss', format_time(start),
+                       '-i', f1,
+                       '-threads', str(nthreads),
+                       '-c:v', args.codec_video,
+                       '-preset', args.preset,
+                       '-b:v', str(td1.bitrate)]
+
+                if args.nframes != 'all':
+                    cmd.extend(['-vframes', str(nfr1)])
+
+                if args.codec_video == "libx265":
+                    cmd.extend(['-vtag', 'hvc1'])
+
+                if td1.audio_stream is not None:
+                    cmd.extend(['-c:a', args.codec_audio,
+                                '-b:a', str(td1.audiobitrate)])
+                else:
+                    cmd.extend(['-an'])
+
+                cmd.append(outf1)
+
+                steps = [(cmd, nfr1)]
+
+            for cmd, _ in steps:
+                logging.debug("Command: {}".format(' '.join(cmd)))
+            jobs.append(EncodeJob(os.path.basename(outf1), steps, tempfiles))
+
+    if args.dry_run or len(jobs) == 0:
+        return
+
+    print("Running {} encodes, {} at a time with {} threads each".format(len(jobs), njobs, nthreads))
+    failed = run_jobs(jobs, njobs)
+    if len(failed) > 0:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
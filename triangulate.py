@@ -1,9 +1,15 @@
 import os, sys
+import copy
+import json
+import hashlib
 from attrs import define, field, Factory
 import aniposelib
 import cv2
-from time import sleep
+from time import sleep, monotonic
+import threading
+import multiprocessing
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 from qtpy import QtCore, QtGui
 from qtpy.QtCore import (
@@ -14,7 +20,8 @@ from qtpy.QtCore import (
 import logging
 logger = logging.getLogger('label3d.triangulate')
 
-from videofile import Video
+from videofile import Video, KeyframeIndex, MAX_FORWARD_DECODE
+from mediainfo import load_sidecar, save_sidecar
 
 from contextlib import contextmanager, redirect_stdout
 import io
@@ -28,13 +35,443 @@ def VideoCapture(filename, *args, **kwargs):
         yield cap
     finally:
         cap.release()
-    
+
+# number of sampled frames that each detection task handles
+DETECT_CHUNK_SIZE = 64
+
+def make_board(params: dict):
+    return aniposelib.boards.CharucoBoard(squaresX=params['nx'],
+                                          squaresY=params['ny'],
+                                          square_length=params['square_size'],
+                                          marker_length=params['marker_size'],
+                                          marker_bits=params['marker_bits'],
+                                          dict_size=params['n_markers_in_dict'])
+
+# boards that have been made in this process, so that each worker only makes one
+_boards = {}
+
+def _get_board(params: dict):
+    key = tuple(sorted(params.items()))
+    if key not in _boards:
+        _boards[key] = make_board(params)
+    return _boards[key]
+
+# width to shrink frames to for the quick look for markers, before the full
+# resolution detection
+COARSE_DETECT_WIDTH = 960
+
+def _detect_markers(gray, dictionary):
+    if hasattr(cv2.aruco, 'ArucoDetector'):
+        # OpenCV >= 4.7
+        detector = cv2.aruco.ArucoDetector(dictionary, cv2.aruco.DetectorParameters())
+        corners, ids, _ = detector.detectMarkers(gray)
+    else:
+        corners, ids, _ = cv2.aruco.detectMarkers(gray, dictionary,
+                                                  parameters=cv2.aruco.DetectorParameters_create())
+    return corners, ids
+
+def find_board_roi(board, gray, width=COARSE_DETECT_WIDTH, margin=0.25):
+    """Looks for markers in a shrunken copy of a grayscale frame.
+
+    Args:
+        board: aniposelib board
+        gray: Full resolution grayscale frame
+        width: Width to shrink the frame to
+        margin: Fraction of the size of the markers' bounding box to add on each side
+
+    Returns:
+        (x, y, w, h) around the markers in full resolution pixels, or None if there
+            weren't any
+    """
+    h, w = gray.shape[:2]
+    scale = min(1.0, width / w)
+    if scale < 1:
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    else:
+        small = gray
+
+    corners, ids = _detect_markers(small, board.dictionary)
+    if ids is None or len(ids) == 0:
+        return None
+
+    pts = np.concatenate([c.reshape(-1, 2) for c in corners]) / scale
+    x0, y0 = pts.min(axis=0)
+    x1, y1 = pts.max(axis=0)
+    pad = margin * max(x1 - x0, y1 - y0)
+
+    x0 = int(max(np.floor(x0 - pad), 0))
+    y0 = int(max(np.floor(y0 - pad), 0))
+    x1 = int(min(np.ceil(x1 + pad), w))
+    y1 = int(min(np.ceil(y1 + pad), h))
+    return x0, y0, x1 - x0, y1 - y0
+
+def detect_board(board, frame, coarse_width=COARSE_DETECT_WIDTH):
+    """Detects the board in a frame, checking a shrunken copy first.
+
+    Frames with no markers at the coarse scale are rejected without running the
+    full detection. Otherwise the board is detected at full resolution, but only
+    in the region around the markers, so the corners are refined at full
+    resolution too.
+
+    Args:
+        board: aniposelib board
+        frame: Color or grayscale frame
+        coarse_width: Width of the shrunken copy. 0 or None to just run
+            `board.detect_image` on the whole frame.
+
+    Returns:
+        (corners, ids) as from `board.detect_image`
+    """
+    if not coarse_width or not hasattr(board, 'dictionary'):
+        return board.detect_image(frame)
+
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+
+    roi = find_board_roi(board, gray, coarse_width)
+    if roi is None:
+        return None, None
+
+    x, y, w, h = roi
+    corners, ids = board.detect_image(gray[y:y+h, x:x+w])
+    if corners is not None and len(corners) > 0:
+        corners = corners + np.array([x, y], dtype=corners.dtype)
+
+    return corners, ids
+
+# width to shrink frames to before measuring sharpness
+SHARPNESS_WIDTH = 480
+# skip frames that are less than this fraction as sharp as the median frame
+BLUR_RATIO = 0.5
+
+def sharpness(frame, width=SHARPNESS_WIDTH) -> float:
+    """Variance of the Laplacian of a shrunken grayscale copy of the frame."""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+
+    scale = min(1.0, width / gray.shape[1])
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    return float(cv2.Laplacian(gray, cv2.CV_32F).var())
+
+class SharpnessFilter:
+    """Picks out blurry frames, compared to the other frames seen so far.
+
+    A frame is blurry if its :func:`sharpness` is less than `ratio` times the
+    median sharpness of the frames before it, so the threshold adapts to the
+    lighting and the amount of texture in each video.
+
+    Args:
+        ratio: Fraction of the median sharpness below which a frame is skipped.
+            0 keeps every frame.
+        warmup: Number of frames to keep before there's a median to compare to
+    """
+    def __init__(self, ratio=BLUR_RATIO, warmup=5):
+        self.ratio = ratio
+        self.warmup = warmup
+        self.scores = []
+
+    def reset(self):
+        self.scores = []
+
+    def is_sharp(self, frame) -> bool:
+        if not self.ratio:
+            return True
+
+        score = sharpness(frame)
+        self.scores.append(score)
+        if len(self.scores) <= self.warmup:
+            return True
+
+        return score >= self.ratio * np.median(self.scores)
+
+def read_sample_frames(cap, framenums, keyframes=None):
+    """Yields (framenum, frame) for each of framenums, in increasing order.
+
+    Reads forward through the video, grabbing the frames in between without
+    retrieving them, which skips the color conversion. It only seeks when that is
+    faster: when there is a keyframe between where the capture is and the next
+    sample, or, without keyframes, when the next sample is more than
+    MAX_FORWARD_DECODE frames ahead.
+
+    Args:
+        cap: Open `cv2.VideoCapture`
+        framenums: Frame numbers to read, in increasing order
+        keyframes: Frame numbers of the keyframes, if known
+    """
+    kfi = KeyframeIndex(keyframes=keyframes) if keyframes is not None else None
+
+    # a new capture starts at frame 0
+    pos = 0
+    for framenum in framenums:
+        if framenum < pos:
+            seek = True
+        elif kfi is not None:
+            seek = kfi.keyframe_before(framenum) > pos
+        else:
+            seek = framenum - pos > MAX_FORWARD_DECODE
+
+        if seek:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, framenum)
+            pos = framenum
+
+        while pos < framenum:
+            if not cap.grab():
+                raise KeyError(f"Unable to load frame {framenum}")
+            pos += 1
+
+        success, frame = cap.read()
+        if not success or frame is None:
+            raise KeyError(f"Unable to load frame {framenum}")
+        pos += 1
+
+        yield framenum, frame
+
+def detect_frames(filename: str, framenums: list, offset: int, params: dict,
+                  keyframes=None, cancel=None) -> list:
+    """Detects the board in some frames of a video file.
+
+    Runs in a worker process, so it opens its own capture and makes its own board.
+    Blurry frames are skipped with a :class:`SharpnessFilter`, which starts over
+    for each call.
+
+    Args:
+        filename: Video file
+        framenums: Frames to look at, in increasing order, not counting the offset
+        offset: Synchronization offset of the video (see :class:`videofile.Video`)
+        params: Arguments for :func:`make_board`, 'coarse_width' for
+            :func:`detect_board`, and 'blur_ratio' for :class:`SharpnessFilter`
+        keyframes: Keyframes of the file, for :func:`read_sample_frames`
+        cancel: Event shared with the calling process. If it is set, stop and
+            raise :class:`CalibrationCancelled`
+
+    Returns:
+        (rows, skipped): rows for the frames where the board was found, as in
+            `aniposelib.boards.CalibrationObject.detect_video`, and the blurry
+            frames (not counting the offset) that weren't searched
+    """
+    board = _get_board(params)
+    blur = SharpnessFilter(params.get('blur_ratio', 0))
+
+    rows = []
+    skipped = []
+    with VideoCapture(filename) as cap:
+        for framenum, frame in read_sample_frames(cap, [fr + offset for fr in framenums],
+                                                    keyframes=keyframes):
+            if cancel is not None and cancel.is_set():
+                raise CalibrationCancelled()
+
+            if not blur.is_sharp(frame):
+                skipped.append(framenum - offset)
+                continue
+
+            corners, ids = detect_board(board, frame, params.get('coarse_width'))
+
+            if corners is not None and len(corners) > 0:
+                rows.append({'framenum': (0, framenum - offset), 'corners': corners, 'ids': ids})
+
+    return rows, skipped
+
+@define
+class DetectionCache:
+    """Board detections for one video file, saved in `<video>.board-<key>.npz`.
+
+    The key is a hash of the board and detector parameters, so detections for
+    different boards or settings don't mix. The cache is thrown out if the video
+    changes (see :func:`mediainfo.load_sidecar`). Frames where no board was found are
+    stored too, so they aren't searched again. Frame numbers are in the file, not
+    counting any synchronization offset.
+    """
+    filename: str = field()
+    # board and detector parameters
+    params: dict = field()
+    # frame number -> (corners, ids), or None if there was no board
+    detections: dict = field(factory=dict)
+
+    @property
+    def cachefile(self) -> str:
+        key = hashlib.sha1(json.dumps(self.params, sort_keys=True).encode()).hexdigest()[:12]
+        return f"{self.filename}.board-{key}.npz"
+
+    @classmethod
+    def load(cls, filename: str, params: dict) -> "DetectionCache":
+        cache = cls(filename=filename, params=params)
+
+        data = load_sidecar(cache.cachefile, filename)
+        if data is None:
+            return cache
+
+        counts = data['counts']
+        starts = np.concatenate(([0], np.cumsum(counts)))
+        corners = data['corners'].reshape(-1, 1, 2)
+        ids = data['ids'].reshape(-1, 1)
+
+        for fr, cnt, i0 in zip(data['framenums'], counts, starts):
+            if cnt > 0:
+                cache.detections[int(fr)] = (corners[i0:i0+cnt], ids[i0:i0+cnt])
+            else:
+                cache.detections[int(fr)] = None
+
+        return cache
+
+    def save(self):
+        framenums = np.array(sorted(self.detections), dtype=int)
+        counts = np.zeros(len(framenums), dtype=int)
+        corners = []
+        ids = []
+        for i, fr in enumerate(framenums):
+            det = self.detections[fr]
+            if det is not None:
+                counts[i] = len(det[0])
+                corners.append(np.asarray(det[0], dtype=np.float32).reshape(-1, 2))
+                ids.append(np.asarray(det[1], dtype=np.int32).reshape(-1))
+
+        corners = np.concatenate(corners) if corners else np.zeros((0, 2), dtype=np.float32)
+        ids = np.concatenate(ids) if ids else np.zeros((0,), dtype=np.int32)
+
+        save_sidecar(self.cachefile, self.filename, framenums=framenums, counts=counts,
+                     corners=corners, ids=ids)
+
+    def missing(self, framenums, offset: int = 0) -> list:
+        """Returns the frames (counting the offset) that haven't been searched yet."""
+        return [fr for fr in framenums if fr + offset not in self.detections]
+
+    def add(self, framenums, rows, offset: int = 0):
+        """Stores the rows detected in framenums. Frames without a row had no board."""
+        found = {row['framenum'][1]: row for row in rows}
+        for fr in framenums:
+            row = found.get(fr)
+            self.detections[fr + offset] = (row['corners'], row['ids']) if row is not None else None
+
+    def rows(self, framenums, offset: int = 0) -> list:
+        """Returns rows for the frames in framenums where the board was found."""
+        rows = []
+        for fr in framenums:
+            det = self.detections.get(fr + offset)
+            if det is not None:
+                # first element in key is the video group number - which would allow us, in principle to calibrate
+                # on multiple videos from each camera
+                rows.append({'framenum': (0, fr), 'corners': det[0], 'ids': det[1]})
+        return rows
+
+# seconds between saves of the board detections during a calibration
+CHECKPOINT_INTERVAL = 30
+# seconds between checks for a cancel while detection workers are running
+CANCEL_POLL_INTERVAL = 0.2
+
+class CalibrationCancelled(Exception):
+    pass
+
+# number of frames to keep for bundle adjustment by default
+CALIBRATION_FRAME_BUDGET = 200
+# frames closer than this in board_features to every picked frame, in every
+# camera, count as duplicates
+MIN_FEATURE_DISTANCE = 0.05
+
+def board_features(corners, frame_size) -> np.ndarray:
+    """Describes where the board is in the image and how it's turned.
+
+    Returns:
+        [x, y, size, stretch*cos(2 angle), stretch*sin(2 angle)], where (x, y) is
+            the center of the corners as a fraction of the frame, size is the
+            spread of the corners as a fraction of the frame diagonal, and stretch
+            and angle come from the covariance of the corners, so they change as
+            the board is tilted
+    """
+    w, h = frame_size
+    pts = np.asarray(corners, dtype=np.float64).reshape(-1, 2)
+
+    cx, cy = pts.mean(axis=0)
+    if len(pts) < 3:
+        return np.array([cx / w, cy / h, 0, 0, 0])
+
+    cov = np.cov(pts, rowvar=False)
+    evals, evecs = np.linalg.eigh(cov)
+    size = np.sqrt(max(evals.sum(), 0)) / np.hypot(w, h)
+    stretch = 1 - evals[0] / evals[1] if evals[1] > 0 else 0
+    angle = np.arctan2(evecs[1, 1], evecs[0, 1])
+
+    return np.array([cx / w, cy / h, size, stretch * np.cos(2*angle), stretch * np.sin(2*angle)])
+
+def select_frames(all_rows: list, frame_sizes: list, budget: int = CALIBRATION_FRAME_BUDGET) -> list:
+    """Picks a well spread out set of frames for bundle adjustment.
+
+    Frames are picked greedily. Each frame scores, for each camera that sees the
+    board in it, the distance in :func:`board_features` to the nearest frame
+    already picked for that camera (capped at 1), weighted by the fraction of the
+    board's corners that were found. New positions, sizes and tilts in any camera
+    score highly, and frames seen by several cameras, which tie the cameras
+    together, count more. Frames within MIN_FEATURE_DISTANCE of a picked frame in
+    every camera are near duplicates and are never picked, so fewer than `budget`
+    frames come back if the board didn't move much. The same frames are
+    used for all of the cameras.
+
+    Args:
+        all_rows: Rows for each camera, as from :meth:`Calibration.detect`
+        frame_sizes: (width, height) of each camera
+        budget: Maximum number of frames to keep. 0 keeps them all.
+
+    Returns:
+        Sorted list of the 'framenum' keys of the rows to keep
+    """
+    framenums = sorted({row['framenum'] for rows in all_rows for row in rows})
+    if budget <= 0 or len(framenums) <= budget:
+        return framenums
+
+    col = {fr: i for i, fr in enumerate(framenums)}
+    ncams = len(all_rows)
+    nfr = len(framenums)
+
+    features = np.zeros((ncams, nfr, 5))
+    weights = np.zeros((ncams, nfr))
+    for c, (rows, frame_size) in enumerate(zip(all_rows, frame_sizes)):
+        maxcorners = max((len(row['corners']) for row in rows), default=1)
+
+        for row in rows:
+            i = col[row['framenum']]
+            features[c, i] = board_features(row['corners'], frame_size)
+            weights[c, i] = len(row['corners']) / maxcorners
+
+    # distance from each frame to the closest picked frame, for each camera,
+    # capped at 1
+    mindist = np.ones((ncams, nfr))
+    picked = np.zeros(nfr, dtype=bool)
+    for _ in range(budget):
+        score = np.sum(weights * mindist, axis=0)
+
+        # only frames that are new in at least one camera are worth picking, so a
+        # board held still gives a few frames, not the whole budget
+        novelty = np.max(np.where(weights > 0, mindist, 0), axis=0)
+        score[picked | (novelty < MIN_FEATURE_DISTANCE)] = -1
+
+        i = int(np.argmax(score))
+        if score[i] <= 0:
+            break
+
+        picked[i] = True
+        for c in range(ncams):
+            if weights[c, i] > 0:
+                d = np.linalg.norm(features[c] - features[c, i], axis=1)
+                mindist[c] = np.minimum(mindist[c], d)
+
+    return [fr for fr, p in zip(framenums, picked) if p]
+
+def _get_param(params, name, default):
+    # older projects may not have all of the parameters
+    try:
+        return params[name]
+    except KeyError:
+        return default
+
 class Calibration(QObject):
     finished = QtCore.Signal(list)
-    progress = QtCore.Signal(int, int)
+    # frames done, total frames, blurry frames skipped
+    progress = QtCore.Signal(int, int, int)
 
     def __init__(self, cameranames, videos, framestep, type,
-                 nx, ny, square_size, marker_size, marker_bits, n_markers_in_dict):
+                 nx, ny, square_size, marker_size, marker_bits, n_markers_in_dict,
+                 nworkers=0, use_detection_cache=True, coarse_width=COARSE_DETECT_WIDTH,
+                 frame_budget=CALIBRATION_FRAME_BUDGET, blur_ratio=BLUR_RATIO,
+                 refine_with='Selected frames'):
         super(Calibration, self).__init__()
 
         self.cameranames = cameranames
@@ -48,6 +485,33 @@ class Calibration(QObject):
         self.marker_size = marker_size
         self.marker_bits = marker_bits
         self.n_markers_in_dict = n_markers_in_dict
+
+        # number of processes for board detection. 0 means one per core, and 1
+        # detects in this thread
+        self.nworkers = nworkers if nworkers > 0 else (os.cpu_count() or 1)
+        # reuse board detections saved next to the videos
+        self.use_detection_cache = use_detection_cache
+        # look for markers in frames shrunk to this width before the full detection.
+        # 0 turns it off
+        self.coarse_width = coarse_width
+        # maximum number of frames to use for bundle adjustment. 0 uses all of them
+        self.frame_budget = frame_budget
+        # skip frames less sharp than this fraction of the median. 0 keeps them all
+        self.blur_ratio = blur_ratio
+        # frames to use in :meth:`refine`: 'Selected frames', 'New frames', or 'Subsample'
+        self.refine_with = refine_with
+
+        self.camgroup = None
+        self.board = None
+        # rows for every frame where the board was found, and the frames used in
+        # the last bundle adjustment
+        self.rows = None
+        self.framenums = None
+        # True once bundle adjustment has finished
+        self.calibrated = False
+
+        self._cancel = threading.Event()
+        self._last_checkpoint = 0
         
         logger.debug("In Calibration.__init__")
 
@@ -58,7 +522,37 @@ class Calibration(QObject):
         return cls(cameranames, videos, framestep=params['Frame Step'], type=params['Type'], 
                    nx=params['Number of squares horizontally'], ny=params['Number of squares vertically'],
                    square_size=params['Size of square'], marker_size=params['Size of marker'],
-                   marker_bits=params['Marker bits'], n_markers_in_dict=params['Number of markers'])
+                   marker_bits=params['Marker bits'], n_markers_in_dict=params['Number of markers'],
+                   nworkers=_get_param(params, 'Detection processes', 0),
+                   use_detection_cache=_get_param(params, 'Reuse detections', True),
+                   coarse_width=_get_param(params, 'Coarse detection width', COARSE_DETECT_WIDTH),
+                   frame_budget=_get_param(params, 'Max calibration frames', CALIBRATION_FRAME_BUDGET),
+                   blur_ratio=_get_param(params, 'Blur threshold', BLUR_RATIO),
+                   refine_with=_get_param(params, 'Refine with', 'Selected frames'))
+
+    def start_from(self, other: "Calibration"):
+        """Takes the cameras, rows and frames from an earlier calibration, to refine it."""
+        # copy the cameras, so that a refinement that fails halfway doesn't change
+        # the earlier calibration
+        self.camgroup = copy.deepcopy(other.camgroup)
+        self.rows = other.rows
+        self.framenums = list(other.framenums) if other.framenums is not None else None
+
+    @property
+    def board_params(self) -> dict:
+        return {'nx': self.nx, 'ny': self.ny, 'square_size': self.square_size,
+                'marker_size': self.marker_size, 'marker_bits': self.marker_bits,
+                'n_markers_in_dict': self.n_markers_in_dict}
+
+    @property
+    def detect_params(self) -> dict:
+        """Board parameters plus the detector settings, which both change what's found."""
+        return dict(self.board_params, coarse_width=self.coarse_width)
+
+    def rows_for_frames(self, framenums) -> list:
+        """Returns the rows for each camera in the given frames."""
+        framenums = set(framenums)
+        return [[row for row in rows if row['framenum'] in framenums] for rows in self.rows]
 
     def save_calibration(self, outputfile):
         self.camgroup.dump(outputfile)
@@ -66,53 +560,196 @@ class Calibration(QObject):
     def to_dict(self):
         return self.camgroup.get_dicts()
 
-    @Slot()
-    def run(self):
-        try:
-            board = aniposelib.boards.CharucoBoard(squaresX=self.nx,
-                                                squaresY=self.ny,
-                                                square_length=self.square_size,
-                                                marker_length=self.marker_size,
-                                                marker_bits=self.marker_bits,
-                                                dict_size=self.n_markers_in_dict)
-            logger.debug("Set up boards")
-            self.camgroup = aniposelib.cameras.CameraGroup.from_names(self.cameranames)
+    def cancel(self):
+        """Asks the calibration to stop. Safe to call from any thread."""
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def _checkpoint(self, caches: list, force=False):
+        """Saves the detections so far, at most every CHECKPOINT_INTERVAL seconds."""
+        if not self.use_detection_cache:
+            return
+        if not force and monotonic() - self._last_checkpoint < CHECKPOINT_INTERVAL:
+            return
+
+        for cache in caches:
+            cache.save()
+        self._last_checkpoint = monotonic()
+
+    def _detect_serial(self, board, todo: list, caches: list, offsets: list):
+        n = sum(len(framenums) for framenums in todo)
+        self.progress.emit(0, n, 0)
+
+        # from aniposelib.CameraGroup.get_rows_videos
+        ndone = 0
+        nskipped = 0
+        blur = SharpnessFilter(self.blur_ratio)
+        for vnum, (vid, framenums, cache, off) in enumerate(zip(self.videos, todo, caches, offsets)):
+            logger.debug(f"Detecting board in {len(framenums)} frames of video #{vnum}: {vid}")
+
+            if len(framenums) == 0:
+                continue
+
+            kfi = vid.build_keyframe_index()
+            keyframes = kfi.keyframes if kfi is not None else None
+
+            # from aniposelib.CalibrationObject.detect_video
+            # read the samples in one forward pass with our own capture, since the
+            # GUI is reading from the video's capture in other threads
+            with VideoCapture(vid.filename) as cap:
+                for i, (framenum, frame) in enumerate(read_sample_frames(cap, [fr + off for fr in framenums],
+                                                                         keyframes=keyframes)):
+                    if self.cancelled:
+                        raise CalibrationCancelled()
+
+                    # start the blur filter over in the same places as the parallel path
+                    if i % DETECT_CHUNK_SIZE == 0:
+                        blur.reset()
+
+                    framenum = int(framenum) - off
+                    if blur.is_sharp(frame):
+                        rows = []
+                        corners, ids = detect_board(board, frame, self.coarse_width)
+
+                        if corners is not None and len(corners) > 0:
+                            rows.append({'framenum': (0, framenum), 'corners': corners, 'ids': ids})
+
+                        cache.add([framenum], rows, off)
+                        self._checkpoint(caches)
+                    else:
+                        # blurry frames aren't cached, since whether a frame counts as
+                        # blurry depends on the frames around it in this run
+                        nskipped += 1
+
+                    ndone += 1
+                    self.progress.emit(ndone, n, nskipped)
+
+    def _detect_parallel(self, board, todo: list, caches: list, offsets: list):
+        """Detects the board in a pool of processes.
+
+        Each video's frames are split into chunks of DETECT_CHUNK_SIZE, and each
+        chunk is read by its own capture in a worker. The detections go into the
+        caches as chunks finish, so the rows are the same as from
+        :meth:`_detect_serial`.
+        """
+        chunks = []
+        for vnum, framenums in enumerate(todo):
+            for i in range(0, len(framenums), DETECT_CHUNK_SIZE):
+                chunks.append((vnum, framenums[i:i+DETECT_CHUNK_SIZE]))
 
-            nframes_in_vid = self.videos[0].nframes // self.framestep
-            n = nframes_in_vid * len(self.videos)
+        n = sum(len(framenums) for _, framenums in chunks)
+        logger.debug(f"Calibration: detecting in {n} frames with {self.nworkers} processes")
+        self.progress.emit(0, n, 0)
 
-            logger.debug(f"Calibration: using {nframes_in_vid} frames in each video for {len(self.videos)}")
+        if n == 0:
+            return
 
-            # from aniposelib.CameraGroup.get_rows_videos
-            all_rows = []
-            for vnum, (cam, vid) in enumerate(zip(self.camgroup.cameras, self.videos)):
-                logger.debug(f"Detecting board in video #{vnum}: {vid}")
+        # workers can't build the keyframe index safely all at once, so do it here
+        keyframes = []
+        for vid in self.videos:
+            kfi = vid.build_keyframe_index()
+            keyframes.append(kfi.keyframes if kfi is not None else None)
 
-                framenums = range(0, vid.nframes, self.framestep)
-                self.progress.emit(vnum*nframes_in_vid, n)
+        ndone = 0
+        nskipped = 0
+        # fork from a process running Qt and OpenCV threads can deadlock in cv2, so
+        # always start fresh interpreters, as macOS and Windows already do
+        mp_context = multiprocessing.get_context('spawn')
+        with mp_context.Manager() as manager, \
+                ProcessPoolExecutor(max_workers=self.nworkers, mp_context=mp_context) as pool:
+            # the workers check this for every frame, so cancelling doesn't wait
+            # for the chunks that are running
+            cancel = manager.Event()
 
-                # from aniposelib.CalibrationObject.detect_video
-                rows_cam = []
-                rows_vid = []
-                for i, framenum in enumerate(framenums):
-                    frame = vid.get_frame(framenum)
+            futures = {}
+            for vnum, framenums in chunks:
+                vid = self.videos[vnum]
+                fut = pool.submit(detect_frames, vid.filename, framenums,
+                                  offsets[vnum], dict(self.detect_params, blur_ratio=self.blur_ratio),
+                                  keyframes[vnum], cancel)
+                futures[fut] = (vnum, framenums)
 
-                    corners, ids = board.detect_image(frame)
+            try:
+                pending = set(futures)
+                while len(pending) > 0:
+                    # don't block until a chunk finishes, so we notice being cancelled
+                    done, pending = wait(pending, timeout=CANCEL_POLL_INTERVAL,
+                                         return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        vnum, framenums = futures[fut]
+                        rows, skipped = fut.result()
 
-                    if corners is not None and len(corners) > 0:
-                        # first element in key is the video group number - which would allow us, in principle to calibrate
-                        # on multiple videos from each camera
-                        key = (0, framenum)
-                        rows_vid.append({'framenum': key, 'corners': corners, 'ids': ids})
+                        skipped = set(skipped)
+                        caches[vnum].add([fr for fr in framenums if fr not in skipped], rows, offsets[vnum])
+                        self._checkpoint(caches)
 
-                    self.progress.emit(vnum*nframes_in_vid + i, n)
+                        ndone += len(framenums)
+                        nskipped += len(skipped)
+                        self.progress.emit(ndone, n, nskipped)
 
-                rows_vid = board.fill_points_rows(rows_vid)
-                logger.debug(f"{len(rows_vid)} boards detected")
+                    if self.cancelled:
+                        raise CalibrationCancelled()
+            except BaseException:
+                # stop the running chunks and don't start the rest
+                cancel.set()
+                pool.shutdown(wait=True, cancel_futures=True)
+                raise
 
-                rows_cam.extend(rows_vid)
+    def detect(self, board) -> tuple:
+        """Finds the board in every `framestep`th frame of each video.
 
-                all_rows.append(rows_cam)
+        Frames that are already in each video's :class:`DetectionCache` aren't
+        searched again. The caches are saved every CHECKPOINT_INTERVAL seconds
+        and when detection stops for any reason, so a cancelled or crashed
+        calibration picks up where it left off the next time.
+
+        Returns:
+            (all_rows, n): rows for each camera, and the number of frames sampled
+        """
+        samples = [list(range(0, vid.nframes, self.framestep)) for vid in self.videos]
+        offsets = [getattr(vid, 'offset', 0) for vid in self.videos]
+
+        if self.use_detection_cache:
+            caches = [DetectionCache.load(vid.filename, self.detect_params) for vid in self.videos]
+        else:
+            caches = [DetectionCache(filename=vid.filename, params=self.detect_params)
+                      for vid in self.videos]
+
+        todo = [cache.missing(framenums, off) for cache, framenums, off in zip(caches, samples, offsets)]
+        n = sum(len(framenums) for framenums in samples)
+        logger.debug(f"Calibration: {n} frames sampled, {sum(len(t) for t in todo)} not searched yet")
+
+        self._last_checkpoint = monotonic()
+        try:
+            if self.nworkers > 1:
+                self._detect_parallel(board, todo, caches, offsets)
+            else:
+                self._detect_serial(board, todo, caches, offsets)
+        finally:
+            if any(len(t) > 0 for t in todo):
+                self._checkpoint(caches, force=True)
+
+        all_rows = []
+        for vnum, (cache, framenums, off) in enumerate(zip(caches, samples, offsets)):
+            rows_vid = board.fill_points_rows(cache.rows(framenums, off))
+            logger.debug(f"{len(rows_vid)} boards detected in video #{vnum}")
+
+            all_rows.append(rows_vid)
+
+        return all_rows, n
+
+    @Slot()
+    def run(self):
+        all_rows = []
+        try:
+            board = make_board(self.board_params)
+            logger.debug("Set up boards")
+            self.camgroup = aniposelib.cameras.CameraGroup.from_names(self.cameranames)
+
+            all_rows, n = self.detect(board)
 
             logger.debug("Setting video sizes")
 
@@ -128,11 +765,77 @@ class Calibration(QObject):
             # output = f.getvalue()
             # logger.debug(output)
 
-            self.progress.emit(-1, n)
+            self.progress.emit(-1, n, 0)
             self.board = board
             self.rows = all_rows
 
-            error = self.camgroup.calibrate_rows(all_rows, board, init_intrinsics=True, init_extrinsics=True)
+            self.framenums = select_frames(all_rows, [vid.frame_size for vid in self.videos],
+                                           self.frame_budget)
+            logger.debug(f"Using {len(self.framenums)} frames for bundle adjustment")
+            calib_rows = self.rows_for_frames(self.framenums)
+
+            error = self.camgroup.calibrate_rows(calib_rows, board, init_intrinsics=True, init_extrinsics=True)
+            self.calibrated = True
+
+        except CalibrationCancelled:
+            logger.info("Calibration cancelled. The boards found so far are saved for next time")
+
+        except Exception as ex:
+            logger.error(ex)
+
+        finally:
+            logger.debug("Thread done!")
+            self.finished.emit(all_rows)
+
+    @Slot()
+    def refine(self):
+        """Runs bundle adjustment again, starting from the current cameras.
+
+        Doesn't initialize the intrinsics or extrinsics, and only looks for the board
+        again for 'New frames' (which then only searches frames that aren't in the
+        detection cache). The frames used depend on `refine_with`:
+
+        - 'Selected frames': the frames from the last bundle adjustment
+        - 'New frames': those, plus up to `frame_budget` frames that weren't used
+          before
+        - 'Subsample': a new selection of up to `frame_budget` frames from all
+          of the rows
+        """
+        all_rows = self.rows if self.rows is not None else []
+        try:
+            if self.camgroup is None:
+                raise ValueError("Calibrate before refining the calibration")
+
+            board = make_board(self.board_params)
+            self.board = board
+
+            n = 0
+            if self.rows is None or self.refine_with == 'New frames':
+                all_rows, n = self.detect(board)
+                self.rows = all_rows
+
+            frame_sizes = [vid.frame_size for vid in self.videos]
+            if self.refine_with == 'New frames' and self.framenums is not None:
+                used = set(self.framenums)
+                new_rows = [[row for row in rows if row['framenum'] not in used] for rows in all_rows]
+                new = select_frames(new_rows, frame_sizes, self.frame_budget)
+                logger.debug(f"Adding {len(new)} new frames")
+                framenums = sorted(used | set(new))
+            elif self.refine_with == 'Subsample' or self.framenums is None:
+                framenums = select_frames(all_rows, frame_sizes, self.frame_budget)
+            else:
+                framenums = self.framenums
+
+            self.framenums = framenums
+            logger.debug(f"Refining calibration on {len(framenums)} frames")
+
+            self.progress.emit(-1, n, 0)
+            error = self.camgroup.calibrate_rows(self.rows_for_frames(framenums), board,
+                                                 init_intrinsics=False, init_extrinsics=False)
+            self.calibrated = True
+
+        except CalibrationCancelled:
+            logger.info("Calibration cancelled. The boards found so far are saved for next time")
 
         except Exception as ex:
             logger.error(ex)
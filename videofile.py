@@ -1,8 +1,13 @@
 import os, sys
+import json
+from collections import OrderedDict
+import threading
+import queue
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 from attrs import define, field
 import numpy as np
-from scipy import signal
 from datetime import datetime, time
 import re
 import ffmpegio
@@ -10,18 +15,354 @@ import ffmpegio
 import logging
 logger = logging.getLogger('label3d')
 
+from mediainfo import (probe_file, probe_video_packets, streams_of_type, video_info,
+                       file_fingerprint, load_sidecar, save_sidecar)
+from audio import audio_envelope
+
 if not ffmpegio.is_ready():
     raise(OSError("Could not find ffprobe or ffmpeg"))
 
+# without a keyframe index, decode forward rather than seek if the requested frame
+# is at most this many frames ahead
+MAX_FORWARD_DECODE = 30
+
+# seconds to wait for the read-ahead thread to deliver a frame before giving up on it
+READAHEAD_TIMEOUT = 5.0
+
+@define
+class FrameCache:
+    """Least-recently-used cache of decoded frames with a memory budget.
+
+    Args:
+        max_mb: Maximum amount of memory to use for cached frames, in MB
+    """
+    max_mb: float = field(default=256)
+
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+
+    _frames = field(factory=OrderedDict, init=False)
+    _nbytes: int = field(default=0, init=False)
+
+    @property
+    def max_bytes(self) -> int:
+        return int(self.max_mb * 1024 * 1024)
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def __contains__(self, idx) -> bool:
+        return idx in self._frames
+
+    def get(self, idx):
+        """Returns the cached frame, or None if it isn't in the cache."""
+        try:
+            frame = self._frames[idx]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self._frames.move_to_end(idx)
+        self.hits += 1
+        return frame
+
+    def put(self, idx, frame: np.ndarray) -> np.ndarray:
+        """Adds a frame to the cache.
+
+        The frame is made read-only, so that nothing can change the cached copy.
+
+        Returns:
+            The frame, read-only if it was cached
+        """
+        if frame.nbytes > self.max_bytes:
+            return frame
+
+        if idx in self._frames:
+            self._nbytes -= self._frames.pop(idx).nbytes
+
+        frame.flags.writeable = False
+        self._frames[idx] = frame
+        self._nbytes += frame.nbytes
+
+        while self._nbytes > self.max_bytes:
+            _, old = self._frames.popitem(last=False)
+            self._nbytes -= old.nbytes
+
+        return frame
+
+    def clear(self):
+        self._frames.clear()
+        self._nbytes = 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+@define
+class KeyframeIndex:
+    """Frame numbers of the keyframes in the first video stream of a file.
+
+    Built from the packet flags reported by ffprobe, which doesn't need to decode
+    anything, and cached next to the video in `<filename>.keyframes.npz`.
+    """
+    keyframes: np.ndarray = field()
+    # number of packets in the stream, or None if we don't know
+    npackets: int = field(default=None)
+
+    @classmethod
+    def from_file(cls, filename: str, cache: bool = True, nframes: int = None) -> "KeyframeIndex":
+        """Loads or builds the index for a file.
+
+        Args:
+            filename: Video file
+            cache: Use the cached index, and save it if it has to be built
+            nframes: Number of frames in the video, to check the index against
+
+        Raises:
+            ValueError: if the index can't be trusted to give frame numbers: it has
+                no keyframes, or a different number of packets than `nframes`
+        """
+        cachefile = filename + '.keyframes.npz'
+
+        kfi = None
+        if cache:
+            data = load_sidecar(cachefile, filename)
+            # older caches don't have the number of packets, so build them again
+            if data is not None and 'npackets' in data:
+                kfi = cls(keyframes=data['keyframes'], npackets=int(data['npackets']))
+
+        if kfi is None:
+            _, iskey = probe_video_packets(filename)
+            kfi = cls(keyframes=np.flatnonzero(iskey), npackets=len(iskey))
+
+            if cache:
+                save_sidecar(cachefile, filename, keyframes=kfi.keyframes, npackets=kfi.npackets)
+
+        if len(kfi.keyframes) == 0:
+            raise ValueError(f"No keyframes found in {filename}")
+        if nframes is not None and kfi.npackets != nframes:
+            raise ValueError(f"{kfi.npackets} packets but {nframes} frames in {filename}")
+
+        return kfi
+
+    def __len__(self) -> int:
+        return len(self.keyframes)
+
+    def keyframe_before(self, idx: int) -> int:
+        """Returns the last keyframe at or before frame idx."""
+        i = np.searchsorted(self.keyframes, idx, side='right') - 1
+        if i < 0:
+            return 0
+        return int(self.keyframes[i])
+
+@define
+class SeekStats:
+    """Counts how much decoding it took to get to requested frames."""
+    # number of times we decoded forward from the current position
+    forward: int = field(default=0)
+    # number of times we seeked to a keyframe
+    seeks: int = field(default=0)
+    # total frames decoded, including the ones that were requested
+    decoded: int = field(default=0)
+    # frames decoded to get the most recent frame
+    last: int = field(default=0)
+
+    def add(self, ndecoded: int, seek: bool):
+        if seek:
+            self.seeks += 1
+        else:
+            self.forward += 1
+        self.decoded += ndecoded
+        self.last = ndecoded
+
+    def reset(self):
+        self.forward = 0
+        self.seeks = 0
+        self.decoded = 0
+        self.last = 0
+
+@define
+class FrameProxy:
+    """Decoded frames of a video, stored in a memory-mapped .npy file.
+
+    The .npy header records the shape and dtype of the frames. A JSON file next to
+    it records which video the frames came from and how they were made, so that the
+    proxy is ignored if the video changes. Reading a frame just returns a view into
+    the memory map, with no decoding.
+    """
+    filename: str = field()
+    frames: np.ndarray = field()
+    # number of frames that were actually decoded into the file
+    nframes: int = field()
+    scale: float = field(default=None)
+    gray: bool = field(default=False)
+
+    @classmethod
+    def create(cls, video, filename: str, scale=None, gray=False, progress=None) -> "FrameProxy":
+        """Decodes every frame of a :class:`MediaVideo` into a proxy file.
+
+        Args:
+            video: Video to decode
+            filename: Name of the .npy file to write
+            scale: Factor to resize frames by
+            gray: Store grayscale frames
+            progress: Optional function called with (frame, nframes) as we go
+
+        Returns:
+            The new FrameProxy
+        """
+        nframes = video.nframes
+        shape = (nframes,) + video._output_shape(None, scale, gray)
+        logger.debug(f"Making proxy {filename} for {video}: {shape}")
+
+        # write to a temporary file, so that an interrupted proxy never looks valid
+        tmpname = filename + '.tmp'
+        frames = np.lib.format.open_memmap(tmpname, mode='w+', dtype=np.uint8, shape=shape)
+
+        nread = 0
+        try:
+            for idx, frame in video.get_frames(range(nframes), scale=scale, gray=gray, stack=False):
+                frames[idx] = frame
+                nread = idx + 1
+                if progress is not None:
+                    progress(idx, nframes)
+        except KeyError:
+            logger.warning(f"Could only decode {nread} of {nframes} frames from {video}")
+        except BaseException:
+            # cancelled or failed, so don't leave a partial file behind
+            del frames
+            os.remove(tmpname)
+            raise
+
+        frames.flush()
+        del frames
+        os.replace(tmpname, filename)
+
+        info = file_fingerprint(video.filename)
+        info.update({'video': os.path.basename(video.filename),
+                     'nframes': nread, 'scale': scale, 'gray': gray})
+        with open(filename + '.json', 'w') as f:
+            json.dump(info, f)
+
+        return cls.open(filename, video.filename)
+
+    @classmethod
+    def open(cls, filename: str, videofile: str):
+        """Opens a proxy file, or returns None if it's missing or out of date."""
+        try:
+            with open(filename + '.json', 'r') as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        fp = file_fingerprint(videofile)
+        if any(info.get(k) != v for k, v in fp.items()):
+            logger.debug(f"Proxy {filename} is out of date for {videofile}")
+            return None
+
+        frames = np.load(filename, mmap_mode='r')
+        return cls(filename=filename, frames=frames, nframes=info['nframes'],
+                   scale=info['scale'], gray=info['gray'])
+
+    def get_frame(self, idx: int) -> np.ndarray:
+        if idx < 0 or idx >= self.nframes:
+            raise KeyError(f"No frame {idx} in proxy {self.filename}.")
+        return self.frames[idx]
+
+class FrameReader(threading.Thread):
+    """Decodes frames in order in a background thread.
+
+    Frames go into a bounded queue as (index, frame) tuples, so the reader never
+    gets more than `maxsize` frames ahead of whoever is consuming them. A `None`
+    in the queue marks the end of the video.
+
+    Args:
+        filename: Video file to read. The reader opens its own capture.
+        first: Index of the first frame to decode
+        maxsize: Number of frames to decode ahead
+    """
+    def __init__(self, filename: str, first: int, maxsize: int):
+        super().__init__(daemon=True)
+        self.filename = filename
+        self.first = first
+        self.queue = queue.Queue(maxsize=maxsize)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        cap = cv2.VideoCapture(self.filename)
+        try:
+            if self.first > 0:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, self.first)
+
+            idx = self.first
+            while not self._stop_event.is_set():
+                success, frame = cap.read()
+                if not success or frame is None:
+                    self._put(None)
+                    break
+
+                if not self._put((idx, frame)):
+                    break
+                idx += 1
+        except Exception as err:
+            logger.warning(f"Read-ahead of {self.filename} stopped: {err}")
+            # still mark the end, so that nobody waits for frames that won't come
+            self._put(None)
+        finally:
+            cap.release()
+
+    def _put(self, item) -> bool:
+        # don't block forever on a full queue, or we'd never notice being stopped
+        while not self._stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, timeout=None):
+        return self.queue.get(timeout=timeout)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
 @define(order=False)
 class MediaVideo:
     filename: str = field()
     timecode = field(default=None)
     audiorate = field(default=None)
+    # memory budget for decoded frames, in MB. 0 turns off caching
+    cache_size: float = field(default=256)
+    # number of frames to decode ahead in a background thread during sequential
+    # playback. 0 turns off read-ahead
+    readahead: int = field(default=0)
+    # use (and build if needed) a keyframe index to decide how to seek
+    use_keyframe_index: bool = field(default=True)
+    seek_stats: SeekStats = field(factory=SeekStats)
+    # memory-mapped proxy file to read frames from instead of decoding, if it exists
+    proxy_file: str = field(default=None)
+    # where to cache ffprobe results (see :func:`mediainfo.probe_file`)
+    metadata_cache = field(default=True)
 
+    _cache = field(default=None)
+    _proxy_ = field(default=None)
+    _keyframe_index_ = field(default=None)
+    _keyframe_thread_ = field(default=None)
+    _keyframe_lock = field(factory=threading.Lock)
+    # index of the next frame that the reader will return, or None if we don't know
+    _pos = field(default=None)
+    _readahead_ = field(default=None)
+    _readahead_next = field(default=None)
+    _last_idx = field(default=None)
     _reader_ = field(default=None)
     _filedata_ = field(default=None)
-    _frame = field(default=None)
+    _info_ = field(default=None)
     _is_audio = field(default=None)
     _audio = field(default=None)
 
@@ -40,6 +381,7 @@ class MediaVideo:
             # Try and open the file either locally in current directory or with full
             # path
             self._reader_ = cv2.VideoCapture(self.filename)
+            self._pos = 0
 
         # Return cached reader
         return self._reader_
@@ -47,77 +389,89 @@ class MediaVideo:
     @property
     def __filedata(self):
         if self._filedata_ is None:
-            self._filedata_ = ffmpegio.probe.video_streams_basic(self.filename)
+            self._filedata_ = probe_file(self.filename, cache=self.metadata_cache)
 
         return self._filedata_
 
+    @property
+    def _info(self) -> dict:
+        if self._info_ is None:
+            self._info_ = video_info(self.__filedata)
+        return self._info_
+
     @property
     def fps(self) -> float:
         """Returns frames per second of video."""
-        return self.__reader.get(cv2.CAP_PROP_FPS)
+        return self._info['fps']
 
     @property
     def nframes(self) -> int:
-        return int(self.__reader.get(cv2.CAP_PROP_FRAME_COUNT))
+        return self._info['nframes']
     
     @property
     def frame(self):
-        self._frame = self.__reader.get(cv2.CAP_PROP_POS_FRAMES) - 1
+        """Index of the last frame returned, or None if we haven't read any yet."""
+        return self._last_idx
 
     @frame.setter
     def frame(self, fr):
-        if self._frame != fr:
-            self.__reader.set(cv2.CAP_PROP_POS_FRAMES, fr)
+        # nothing is decoded until the next read, which then returns frame fr+1
+        self._last_idx = fr
 
     @property
     def frame_size(self):
-        width  = int(self.__reader.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(self.__reader.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        
-        return (width, height)
+        return (self._info['width'], self._info['height'])
     
     def audio(self, audiorate=500):
+        """Returns the rate and amplitude envelope of the audio track.
+
+        The envelope is computed in one streaming pass over the audio and cached
+        next to the video in `<filename>.audio.npz`.
+        """
         if not self.is_audio:
             return None, None
         
         if self._audio is None:
-            hirate, a = ffmpegio.audio.read(self.filename)
-            self.audiorate, self._audio = self._decimate_audio(a, hirate, audiorate)
+            self.audiorate, self._audio = self._load_audio()
 
         return self.audiorate, self._audio
 
-    def _decimate_audio(self, a, hirate, audiorate):
-        dec = round(hirate/1000)
-        audiorate = hirate / dec
+    def _load_audio(self):
+        cachefile = self.filename + '.audio.npz'
 
-        if dec > 13:
-            dec = [8, int(dec/8)]
-        else:
-            dec = [int(dec)]
+        data = load_sidecar(cachefile, self.filename)
+        if data is not None:
+            return float(data['rate']), data['envelope']
 
-        logger.debug(f"Decimate audio by {dec}")
+        hirate = float(streams_of_type(self.__filedata, 'audio')[0]['sample_rate'])
+        rate, envelope = audio_envelope(self.filename, hirate)
 
-        alo = np.abs(a[:,0])
-        for d1 in dec:
-            alo = signal.decimate(alo, d1)
-        
-        return audiorate, alo
+        save_sidecar(cachefile, self.filename, rate=rate, envelope=envelope)
+
+        return rate, envelope
 
     @property
     def is_audio(self):
         if self._is_audio is None:
-            self._is_audio = len(ffmpegio.probe.audio_streams_basic(self.filename)) > 0
+            self._is_audio = len(streams_of_type(self.__filedata, 'audio')) > 0
         return self._is_audio
     
     def __repr__(self):
         return os.path.basename(self.filename)
     
+    def get_timecode(self):
+        """Returns the date and time of the first frame from the timecode, or None."""
+        if self.timecode is None:
+            self._parse_timecode()
+        return self.timecode
+
     def _parse_timecode(self):
         frame_rate = self.fps
 
         try:
-            creation_time = self.__filedata[0]['tags']['creation_time']
-            timecode = self.__filedata[0]['tags']['timecode']
+            tags = streams_of_type(self.__filedata, 'video')[0]['tags']
+            creation_time = tags['creation_time']
+            timecode = tags['timecode']
             
             creation_time = datetime.fromisoformat(str(creation_time).replace('Z', '+00:00'))
 
@@ -138,26 +492,307 @@ class MediaVideo:
             self.timecode = None
 
     def get_next_frame(self) -> np.ndarray:
-        success, frame = self.__reader.read()
+        """Returns the frame after the last one that was read."""
+        if self._last_idx is None:
+            return self.get_frame(0)
+        return self.get_frame(self._last_idx + 1)
 
-        if not success or frame is None:
-            raise KeyError(f"Unable to load frame from {self}.")
+    @property
+    def keyframe_index(self):
+        """Keyframe index for the video, or None if it isn't ready.
 
-        return frame
+        Building the index reads every packet header in the file, so the first time
+        this is called it starts building in a background thread, and until that
+        finishes seeking works as if there were no index.
+        """
+        if self._keyframe_index_ is None and self.use_keyframe_index and \
+                self._keyframe_thread_ is None:
+            self._keyframe_thread_ = threading.Thread(target=self.build_keyframe_index,
+                                                      daemon=True)
+            self._keyframe_thread_.start()
+
+        return self._keyframe_index_
+
+    def build_keyframe_index(self):
+        """Builds the keyframe index now, if it isn't built already.
+
+        Blocks until the index is ready, so call it from a worker thread.
+
+        Returns:
+            The :class:`KeyframeIndex`, or None if it couldn't be built
+        """
+        with self._keyframe_lock:
+            if self._keyframe_index_ is None and self.use_keyframe_index:
+                try:
+                    self._keyframe_index_ = KeyframeIndex.from_file(self.filename,
+                                                                    nframes=self.nframes)
+                except Exception as err:
+                    # without an index we fall back to seeking by MAX_FORWARD_DECODE
+                    logger.warning(f"Could not build keyframe index for {self}: {err}")
+                    self.use_keyframe_index = False
+
+        return self._keyframe_index_
+
+    @property
+    def cache(self) -> FrameCache:
+        if self._cache is None:
+            self._cache = FrameCache(max_mb=self.cache_size)
+        return self._cache
+
+    @property
+    def proxy(self):
+        """The frame proxy for this video, or None if there isn't a valid one."""
+        if self._proxy_ is None and self.proxy_file is not None:
+            self._proxy_ = FrameProxy.open(self.proxy_file, self.filename)
+            if self._proxy_ is None:
+                # don't keep looking for it
+                self.proxy_file = None
+
+        return self._proxy_
+
+    def make_proxy(self, filename: str, scale=None, gray=False, progress=None) -> FrameProxy:
+        """Decodes the whole video into a memory-mapped proxy file and reads from it from now on.
+
+        Frames from a scaled or grayscale proxy are resized and converted back to full
+        size BGR frames as they're read, so they lose detail but keep the same pixel
+        coordinates as the video.
+        """
+        self._proxy_ = FrameProxy.create(self, filename, scale=scale, gray=gray, progress=progress)
+        self.proxy_file = filename
+        return self._proxy_
+
+    def use_proxy(self, filename: str):
+        """Reads frames from the proxy in `filename` from now on, if it's valid."""
+        self.proxy_file = filename
+        self._proxy_ = None
 
     def get_frame(self, idx: int) -> np.ndarray:
-        """See :class:`Video`."""
+        """Returns frame idx.
 
+        Frames that go through the frame cache or come from a proxy are read-only,
+        whether or not they were decoded just now, so copy the frame before drawing
+        on it or using it as a `dst=` buffer.
+        """
+
+        proxy = self.proxy
+        if proxy is not None:
+            self._last_idx = idx
+            frame = proxy.get_frame(idx)
+            if proxy.gray and self._channels == 3:
+                frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+            if proxy.scale is not None:
+                frame = cv2.resize(frame, self.frame_size, interpolation=cv2.INTER_LINEAR)
+            return frame
+
+        if self.cache_size > 0:
+            frame = self.cache.get(idx)
+            if frame is not None:
+                self._last_idx = idx
+                return frame
+
+        sequential = self._last_idx is not None and idx == self._last_idx + 1
+
+        if self.readahead > 0 and self._readahead_ is not None and \
+                self._readahead_next <= idx < self._readahead_next + self.readahead:
+            frame = self._get_readahead_frame(idx)
+        else:
+            # any jump cancels the read-ahead thread
+            self.stop_readahead()
+
+            frame = self._decode_frame(idx)
+
+            # start reading ahead once it looks like we're playing forward
+            if self.readahead > 0 and sequential:
+                self._start_readahead(idx + 1)
+
+        self._last_idx = idx
+
+        if self.cache_size > 0:
+            frame = self.cache.put(idx, frame)
+
+        return frame
+
+    def get_frames(self, indices, roi=None, scale=None, gray=False, stack=True):
+        """Reads a batch of frames, decoding them in increasing order.
+
+        Cropping, resizing and grayscale conversion happen as each frame is decoded,
+        writing straight into preallocated output buffers. Batch reads skip the frame
+        cache and read-ahead.
+
+        Args:
+            indices: Frame numbers to read
+            roi: Region to crop (x, y, width, height), in full frame pixels
+            scale: Factor to resize frames by, after cropping
+            gray: Convert frames to grayscale
+            stack: If True, return all of the frames stacked in one array, in the same
+                order as `indices`. If False, return a generator of (index, frame)
+                tuples in increasing frame order. The generator reuses one output
+                buffer, so copy the frame if you need to keep it.
+
+        Returns:
+            Array of frames, or a generator of (index, frame) tuples
+        """
+        indices = np.asarray(indices, dtype=int).ravel()
+        shape = self._output_shape(roi, scale, gray)
+
+        if stack:
+            out = np.empty((len(indices),) + shape, dtype=np.uint8)
+            for _ in self._read_frames(indices, roi, scale, gray, out):
+                pass
+            return out
+        else:
+            return self._read_frames(indices, roi, scale, gray, None)
+
+    @property
+    def _channels(self) -> int:
+        """Number of color channels in decoded frames."""
+        return 3
+
+    def _output_shape(self, roi, scale, gray) -> tuple:
+        if roi is not None:
+            w, h = roi[2], roi[3]
+        else:
+            w, h = self.frame_size
+
+        if scale is not None:
+            w, h = int(round(w * scale)), int(round(h * scale))
+
+        # a backend that decodes to grayscale can't give color frames
+        if gray or self._channels == 1:
+            return (h, w)
+        else:
+            return (h, w, 3)
+
+    def _read_frames(self, indices, roi, scale, gray, out):
+        self.stop_readahead()
+
+        shape = self._output_shape(roi, scale, gray)
+        if out is None:
+            buf = np.empty(shape, dtype=np.uint8)
+        # intermediate buffer for resizing before the gray conversion
+        tmp = np.empty(shape + (3,), dtype=np.uint8) \
+            if scale is not None and gray and self._channels == 3 else None
+
+        order = np.argsort(indices, kind='stable')
+        prev_idx, prev_slot = None, None
+        for slot in order:
+            idx = int(indices[slot])
+            dst = out[slot] if out is not None else buf
+
+            if idx == prev_idx:
+                # duplicate index, so just copy the last frame
+                if out is not None:
+                    dst[...] = out[prev_slot]
+                    continue
+            else:
+                frame = self._decode_frame(idx)
+                self._process_frame(frame, roi, scale, gray, dst, tmp)
+
+            prev_idx, prev_slot = idx, slot
+            yield idx, dst
+
+    @staticmethod
+    def _process_frame(frame, roi, scale, gray, dst, tmp=None):
+        if roi is not None:
+            x, y, w, h = roi
+            frame = frame[y:y+h, x:x+w]
+
+        # frames that are already grayscale don't need converting
+        convert = gray and frame.ndim == 3
+
+        if scale is not None:
+            dsize = (dst.shape[1], dst.shape[0])
+            resized = tmp if convert else dst
+            cv2.resize(frame, dsize, dst=resized, interpolation=cv2.INTER_AREA)
+            frame = resized
+
+        if convert:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=dst)
+        elif frame is not dst:
+            dst[...] = frame
+
+        return dst
+
+    def _should_seek(self, idx: int) -> bool:
+        """Decides whether to seek or decode forward from the current position."""
+        if self._pos is None or idx < self._pos:
+            return True
+        elif idx == self._pos:
+            # the next frame, so just read it
+            return False
+
+        kfi = self.keyframe_index
+        if kfi is not None:
+            # seeking decodes from the keyframe before idx, so it only helps if
+            # that keyframe is past where we are now
+            return kfi.keyframe_before(idx) > self._pos
+        else:
+            return idx - self._pos > MAX_FORWARD_DECODE
+
+    def _decode_frame(self, idx: int) -> np.ndarray:
         # with self.__lock:
-        if self.frame != idx:
-            self.__reader.set(cv2.CAP_PROP_POS_FRAMES, idx+1)
+        reader = self.__reader
+
+        seek = self._should_seek(idx)
+        if seek:
+            reader.set(cv2.CAP_PROP_POS_FRAMES, idx)
+            kfi = self.keyframe_index
+            start = kfi.keyframe_before(idx) if kfi is not None else idx
+        else:
+            # grab without retrieving, so we skip the color conversion
+            start = self._pos
+            for _ in range(idx - self._pos):
+                if not reader.grab():
+                    self._pos = None
+                    raise KeyError(f"Unable to load frame {idx} from {self}.")
 
-        success, frame = self.__reader.read()
+        success, frame = reader.read()
 
         if not success or frame is None:
+            self._pos = None
             raise KeyError(f"Unable to load frame {idx} from {self}.")
 
+        self._pos = idx + 1
+        self.seek_stats.add(idx - start + 1, seek)
+
+        return frame
+
+    def _start_readahead(self, first: int):
+        self._readahead_ = FrameReader(self.filename, first, self.readahead)
+        self._readahead_.start()
+        self._readahead_next = first
+
+    def _get_readahead_frame(self, idx: int) -> np.ndarray:
+        # skip over any frames that we already got from the cache
+        fr = -1
+        while fr < idx:
+            try:
+                item = self._readahead_.get(timeout=READAHEAD_TIMEOUT)
+            except queue.Empty:
+                logger.warning(f"Read-ahead of {self} stalled; decoding frame {idx} directly")
+                self.stop_readahead()
+                return self._decode_frame(idx)
+
+            if item is None:
+                self.stop_readahead()
+                raise KeyError(f"Unable to load frame {idx} from {self}.")
+
+            fr, frame = item
+
+        self._readahead_next = fr + 1
         return frame
+
+    def stop_readahead(self):
+        if self._readahead_ is not None:
+            self._readahead_.stop()
+            self._readahead_ = None
+            self._readahead_next = None
+
+    def close(self):
+        self.stop_readahead()
+        if self._reader_ is not None:
+            self._reader_.release()
+            self._reader_ = None
     
     def get_info_as_parameters(self):
         p = [{'name': 'Frame rate', 'type': 'float', 
@@ -169,29 +804,154 @@ class MediaVideo:
 
         return p
     
+@define(order=False)
+class FFmpegVideo(MediaVideo):
+    """Video backend that streams raw frames from an ffmpeg process through a pipe.
+
+    Frames are decoded by ffmpeg in a separate process, using `threads` decoding
+    threads. Reading forward just reads the next frame from the pipe. Jumping
+    restarts ffmpeg with an accurate input seek (`-ss` before `-i`), so ffmpeg
+    seeks to the keyframe before the target and drops the frames up to it.
+
+    Args:
+        threads: Number of ffmpeg decoding threads. 0 lets ffmpeg decide.
+        gray: Have ffmpeg convert frames to grayscale
+        scale: Have ffmpeg resize frames by this factor
+    """
+    threads: int = field(default=0)
+    gray: bool = field(default=False)
+    scale: float = field(default=None)
+
+    _proc = field(default=None)
+
+    @property
+    def frame_size(self):
+        """Size of the frames that ffmpeg outputs, after any scaling."""
+        width, height = self._info['width'], self._info['height']
+        if self.scale is not None:
+            width, height = int(round(width * self.scale)), int(round(height * self.scale))
+
+        return (width, height)
+
+    @property
+    def _channels(self) -> int:
+        return 1 if self.gray else 3
+
+    @property
+    def _frame_shape(self) -> tuple:
+        width, height = self.frame_size
+        if self.gray:
+            return (height, width)
+        else:
+            return (height, width, 3)
+
+    def _start_pipe(self, idx: int):
+        self._stop_pipe()
+
+        cmd = [ffmpegio.path.get_ffmpeg(), '-v', 'error', '-nostdin',
+               '-threads', str(self.threads)]
+        if idx > 0:
+            # aim half a frame early, so rounding can't make us drop frame idx
+            cmd.extend(['-accurate_seek', '-ss', '{:.6f}'.format((idx - 0.5) / self.fps)])
+        cmd.extend(['-i', self.filename, '-map', '0:v:0', '-an', '-sn'])
+
+        filters = []
+        if self.scale is not None:
+            filters.append('scale={}:{}:flags=area'.format(*self.frame_size))
+        if len(filters) > 0:
+            cmd.extend(['-vf', ','.join(filters)])
+
+        cmd.extend(['-f', 'rawvideo', '-pix_fmt', 'gray' if self.gray else 'bgr24', '-'])
+
+        logger.debug("Command: {}".format(' '.join(cmd)))
+        self._proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                      bufsize=0)
+        self._pos = idx
+
+    def _stop_pipe(self):
+        if self._proc is not None:
+            self._proc.kill()
+            self._proc.wait()
+            self._proc.stdout.close()
+            self._proc = None
+        self._pos = None
+
+    def _read_pipe(self, idx: int) -> np.ndarray:
+        frame = np.empty(self._frame_shape, dtype=np.uint8)
+        buf = memoryview(frame).cast('B')
+
+        nread = 0
+        while nread < len(buf):
+            n = self._proc.stdout.readinto(buf[nread:])
+            if not n:
+                self._stop_pipe()
+                raise KeyError(f"Unable to load frame {idx} from {self}.")
+            nread += n
+
+        self._pos += 1
+        return frame
+
+    def _decode_frame(self, idx: int) -> np.ndarray:
+        if self._proc is None:
+            self._pos = None
+
+        seek = self._should_seek(idx)
+        if seek:
+            self._start_pipe(idx)
+            kfi = self.keyframe_index
+            start = kfi.keyframe_before(idx) if kfi is not None else idx
+        else:
+            start = self._pos
+            while self._pos < idx:
+                self._read_pipe(self._pos)
+
+        frame = self._read_pipe(idx)
+        self.seek_stats.add(idx - start + 1, seek)
+
+        return frame
+
+    def _start_readahead(self, first: int):
+        # ffmpeg already decodes ahead of us into the pipe
+        pass
+
+    def close(self):
+        self._stop_pipe()
+        super().close()
+
 @define(order=False)
 class Video:
     backend = field()
+    # synchronization offset, so that frame idx of this video is frame idx + offset
+    # of the file
+    offset: int = field(default=0)
 
     def __getattr__(self, item):
         return getattr(self.backend, item)
     
     @classmethod
-    def from_media(cls, filename: str, *args, **kwargs) -> "Video":
+    def from_media(cls, filename: str, *args, backend: str = 'opencv', **kwargs) -> "Video":
         """Create an instance of a video object from a typical media file.
 
         For example, mp4, avi, or other types readable by FFMPEG.
 
         Args:
             filename: The name of the file
-            args: Arguments to pass to :class:`MediaVideo`
-            kwargs: Arguments to pass to :class:`MediaVideo`
+            backend: 'opencv' to decode with :class:`MediaVideo` or 'ffmpeg' to
+                decode through a pipe with :class:`FFmpegVideo`
+            args: Arguments to pass to the backend
+            kwargs: Arguments to pass to the backend
 
         Returns:
-            A Video object with a MediaVideo backend
+            A Video object with a MediaVideo or FFmpegVideo backend
         """
 
-        backend = MediaVideo(filename=filename, *args, **kwargs)
+        if backend == 'opencv':
+            backend = MediaVideo(filename=filename, *args, **kwargs)
+        elif backend == 'ffmpeg':
+            backend = FFmpegVideo(filename=filename, *args, **kwargs)
+        else:
+            raise ValueError(f"Unknown video backend {backend}")
+
         return cls(backend=backend)
 
     def __len__(self) -> int:
@@ -199,11 +959,87 @@ class Video:
     
     def __repr__(self):
         return self.backend.__repr__()
+
+    @property
+    def nframes(self) -> int:
+        """Number of frames after the synchronization offset."""
+        return self.backend.nframes - self.offset
     
     def get_frame(self, idx: int) -> np.ndarray:
-        return self.backend.get_frame(idx)
+        if idx + self.offset < 0:
+            raise KeyError(f"No frame {idx} in {self} with offset {self.offset}.")
+        return self.backend.get_frame(idx + self.offset)
+
+    def get_frames(self, indices, roi=None, scale=None, gray=False, stack=True):
+        """See :meth:`MediaVideo.get_frames`."""
+        indices = np.asarray(indices, dtype=int) + self.offset
+        if np.any(indices < 0):
+            raise KeyError(f"Frames before the start of {self} with offset {self.offset}.")
+
+        frames = self.backend.get_frames(indices, roi=roi, scale=scale, gray=gray, stack=stack)
+        if stack:
+            return frames
+        else:
+            return ((idx - self.offset, frame) for idx, frame in frames)
     
     def get_info_as_parameters(self):
         return self.backend.get_info_as_parameters()
-    
-    
\ No newline at end of file
+
+@define(order=False)
+class MultiVideo:
+    """Reads the same frame from several synchronized videos at once.
+
+    Each video is decoded in its own worker thread, so getting a frame from all
+    of the cameras takes about as long as the slowest single decode.
+
+    Args:
+        videos: List of :class:`Video` objects, one per camera
+        offsets: Extra frame offset for each video, so that frame k of the group is
+            frame k + offsets[i] in video i. This is on top of each
+            :class:`Video`'s own offset. Defaults to no offset.
+    """
+    videos: list = field()
+    offsets: list = field(default=None)
+
+    _pool = field(default=None, init=False)
+
+    def __attrs_post_init__(self):
+        if self.offsets is None:
+            self.offsets = [0] * len(self.videos)
+        elif len(self.offsets) != len(self.videos):
+            raise ValueError(f"Need one offset per video. Got {len(self.offsets)} offsets for {len(self.videos)} videos")
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=max(len(self.videos), 1),
+                                            thread_name_prefix='MultiVideo')
+        return self._pool
+
+    def __len__(self) -> int:
+        return len(self.videos)
+
+    @property
+    def nframes(self) -> int:
+        """Number of frames in the group, including frames that only some videos have."""
+        return max(len(vid) - off for vid, off in zip(self.videos, self.offsets))
+
+    def _get_one(self, vid, idx: int):
+        if idx < 0 or idx >= len(vid) or idx + getattr(vid, 'offset', 0) < 0:
+            return None
+        return vid.get_frame(idx)
+
+    def get_frame(self, idx: int) -> tuple:
+        """Returns frame idx from every video.
+
+        Videos that don't have a frame at idx, given their offset, return None.
+        """
+        futures = [self.pool.submit(self._get_one, vid, idx + off)
+                   for vid, off in zip(self.videos, self.offsets)]
+
+        return tuple(f.result() for f in futures)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
@@ -34,6 +34,7 @@ import logging
 logger = logging.getLogger('label3d')
 
 from project import Project
+from audio import MinMaxPyramid
 
 pg.setConfigOption('background', 'w')
 pg.setConfigOption('foreground', 'k')
@@ -42,6 +43,8 @@ class VideoControlPanel(QDockWidget):
     addedVideos = QtCore.Signal(list)
     syncVideos = QtCore.Signal()
     doCalibrate = QtCore.Signal()
+    cancelCalibration = QtCore.Signal()
+    cancelProxies = QtCore.Signal()
 
     def __init__(self, main_window: QMainWindow, project: Project):
         super().__init__("Video Control")
@@ -80,8 +83,8 @@ class VideoControlPanel(QDockWidget):
     def updateParameters(self):
         logger.debug("Parameters should have updated...")
 
-    @Slot(int, int)
-    def show_calibration_progress(self, i,n):
+    @Slot(int, int, int)
+    def show_calibration_progress(self, i, n, nskipped=0):
         try:
             progress = self.parameters.child('Calibration', 'Progress')
         except KeyError:
@@ -90,8 +93,18 @@ class VideoControlPanel(QDockWidget):
 
             calibrate_button = self.parameters.child('Calibration', 'Calibrate...')
             calibrate_button.hide()
+
+            cancel_button = Parameter.create(name='Cancel', type='action')
+            cancel_button.sigActivated.connect(self.cancelCalibration.emit)
+            self.parameters.child('Calibration').addChild(cancel_button)
         
         if i < 0:
+            # bundle adjustment can't be cancelled
+            try:
+                self.parameters.child('Calibration', 'Cancel').remove()
+            except KeyError:
+                pass
+
             try:
                 logger.debug('Trying to replace parameter')
                 new_progress = Parameter.create(name='Progress', type='str', value='Working...')
@@ -108,12 +121,19 @@ class VideoControlPanel(QDockWidget):
         elif i < n:
             pct = int((i*100) / n)
             progress.setValue(pct)
+            if nskipped > 0:
+                progress.setOpts(tip=f"Skipped {nskipped} blurry frames")
 
     @Slot(list)
     def calibration_finished(self, rows):
         try:
             logger.debug('VideoControlPanel.calibration_finished')
 
+            try:
+                self.parameters.child('Calibration', 'Cancel').remove()
+            except KeyError:
+                pass
+
             progress = self.parameters.child('Calibration', 'Progress')
             progress.remove()
             calibrate_button = self.parameters.child('Calibration', 'Calibrate...')
@@ -122,6 +142,39 @@ class VideoControlPanel(QDockWidget):
             logger.debug(f'KeyError! {err}')
             pass
 
+    @Slot(int, int, int)
+    def show_proxy_progress(self, vnum, i, n):
+        try:
+            progress = self.parameters.child('Frame proxies', 'Progress')
+        except KeyError:
+            progress = parameterTypes.ProgressBarParameter(name="Progress")
+            self.parameters.child('Frame proxies').addChild(progress)
+
+            self.parameters.child('Frame proxies', 'Make proxies...').hide()
+
+            cancel_button = Parameter.create(name='Cancel', type='action')
+            cancel_button.sigActivated.connect(self.cancelProxies.emit)
+            self.parameters.child('Frame proxies').addChild(cancel_button)
+
+        nvideos = max(len(self.project.videos), 1)
+        pct = int(((vnum + i / max(n, 1)) * 100) / nvideos)
+        progress.setValue(pct)
+        progress.setOpts(tip=f"Video {vnum+1} of {nvideos}")
+
+    @Slot(list)
+    def proxies_finished(self, proxyfiles):
+        logger.debug('VideoControlPanel.proxies_finished')
+        for name in ['Progress', 'Cancel']:
+            try:
+                self.parameters.child('Frame proxies', name).remove()
+            except KeyError:
+                pass
+
+        try:
+            self.parameters.child('Frame proxies', 'Make proxies...').show()
+        except KeyError as err:
+            logger.debug(f'KeyError! {err}')
+
     def _create_widgets(self, parent):
         layout = QVBoxLayout()
 
@@ -179,6 +232,44 @@ class VideoControlPanel(QDockWidget):
 
         parent.setLayout(layout)
 
+class AudioEnvelopeItem(pg.PlotCurveItem):
+    """Plots an audio envelope from a min/max pyramid.
+
+    Each time the view changes, the item asks the pyramid for the level that
+    matches the visible time range and the width of the plot in pixels.
+    """
+    def __init__(self, pyramid: MinMaxPyramid, *args, **kwargs):
+        super().__init__(*args, connect='all', **kwargs)
+        self.pyramid = pyramid
+        self._shown = None
+
+        t, y = pyramid.get(pyramid.t0, pyramid.t0 + pyramid.duration, 1000)
+        self.setData(t, y)
+
+    def viewRangeChanged(self):
+        vb = self.getViewBox()
+        if vb is None:
+            return
+
+        tmin, tmax = vb.viewRange()[0]
+        npixels = int(vb.width())
+
+        level = self.pyramid.choose_level(tmin, tmax, npixels)
+        if self._shown == (level, tmin, tmax):
+            return
+        self._shown = (level, tmin, tmax)
+
+        t, y = self.pyramid.get(tmin, tmax, npixels)
+        self.setData(t, y)
+
+    def dataBounds(self, ax, frac=1.0, orthoRange=None):
+        # auto-range to the whole recording, not just the part that's loaded
+        if ax == 0:
+            return (self.pyramid.t0, self.pyramid.t0 + self.pyramid.duration)
+        else:
+            mn, mx = self.pyramid.levels[-1]
+            return (float(np.min(mn)), float(np.max(mx)))
+
 class VideoFramePanel(QDockWidget):
     set_frame = QtCore.Signal(int)
 
@@ -216,18 +307,20 @@ class VideoFramePanel(QDockWidget):
         w.show()
 
         self._audio = []
-        self._audio_t = []
+        self._audio_pyramids = []
         self._audio_plots = []
 
         for i, v1 in enumerate(vids):
             arate, a = v1.audio()
             self._audio.append(a)
 
-            t1 = np.arange(0, len(a)) / arate
-            self._audio_t.append(t1)
+            # shift the audio by the synchronization offset, so it lines up with
+            # the frames
+            pyr = MinMaxPyramid(a, arate, t0=-getattr(v1, 'offset', 0) / v1.fps)
+            self._audio_pyramids.append(pyr)
 
             p1 = w.addPlot(row=i, col=0)
-            p1.plot(t1, a, pen=(i, len(vids)))
+            p1.addItem(AudioEnvelopeItem(pyr, pen=(i, len(vids))))
             p1.showAxis('left', False)
             p1.setMouseEnabled(x=True, y=False)
             self._audio_plots.append(p1)
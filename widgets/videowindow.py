@@ -406,15 +406,23 @@ class VideoWindow(QWidget):
     def set_frame(self, fr):
         try:
             img = self.video.get_frame(fr)
-            self.view.setImage(img)
             logger.debug(f"Get frame {fr} from {self.video}")
-            self.frame = fr
-
-            self.show_points_in_frame()
+            self.show_frame(fr, img)
 
         except Exception as err:
             logger.error("Couldn't read video {} frame {}. Error {}".format(self.video, fr, err))
 
+    def show_frame(self, fr, img):
+        """Shows a frame that has already been read from the video."""
+        if img is None:
+            logger.debug(f"No frame {fr} in {self.video}")
+            return
+
+        self.view.setImage(img)
+        self.frame = fr
+
+        self.show_points_in_frame()
+
     @Slot()
     def next_frame(self):
         try: